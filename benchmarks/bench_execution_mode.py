@@ -0,0 +1,53 @@
+"""Compare running cells through `eval` and from cached script files.
+
+This mimics the two values of ``IMATLAB_EXECUTION_MODE`` on a loop-heavy
+cell, evaluated in the base workspace with the kernel's error wrapper.
+Requires the MATLAB engine::
+
+    $ python benchmarks/bench_execution_mode.py [repeats]
+"""
+
+import hashlib
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+import matlab.engine
+
+
+CELL = """\
+acc = 0;
+for i = 1:2e6
+    acc = acc + mod(i, 7) * sin(i);
+end
+"""
+
+
+def wrap(code):
+    return ("try, {}\n"
+            r"catch ME_bench; fprintf('%s\n', ME_bench.getReport); end"
+            .format(code))
+
+
+def main(repeats=5):
+    engine = matlab.engine.start_matlab()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        script = "imatlab_cell_" + hashlib.sha1(CELL.encode()).hexdigest()
+        Path(tmpdir, script + ".m").write_text(CELL)
+        engine.addpath(tmpdir, nargout=0)
+        for mode, code in [("eval", CELL), ("script", script)]:
+            code = wrap(code)
+            engine.evalin("base", code, nargout=0)  # Warm up.
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                engine.evalin("base", code, nargout=0)
+                times.append(time.perf_counter() - start)
+            print("{:>6}: best {:.3f}s, mean {:.3f}s over {} runs".format(
+                mode, min(times), sum(times) / len(times), repeats))
+    engine.quit()
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
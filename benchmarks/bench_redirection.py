@@ -0,0 +1,57 @@
+"""Measure the throughput of the stdout/stderr redirection.
+
+Writer threads push data through two redirected fds (standing in for the
+kernel's stdout and stderr) while the redirection thread forwards it to a
+callback that decodes it, as the kernel does.  Does not require MATLAB::
+
+    $ python benchmarks/bench_redirection.py [megabytes] [chunk_size]
+"""
+
+import codecs
+import os
+import sys
+import threading
+import time
+
+from imatlab import _redirection
+
+
+def main(megabytes=256, chunk_size=65536):
+    total = megabytes << 20
+    chunk = b"x" * (chunk_size - 1) + b"\n"
+    # Redirect private fds rather than the actual stdout/stderr, so that the
+    # results can still be printed.
+    fds = [os.open(os.devnull, os.O_WRONLY) for _ in range(2)]
+    received = [0, 0]
+
+    def make_callback(k):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        def callback(data):
+            received[k] += len(decoder.decode(data))
+        return callback
+
+    def write(fd):
+        remaining = total // len(fds)
+        view = memoryview(chunk)
+        while remaining > 0:
+            remaining -= os.write(fd, view[:min(remaining, len(chunk))])
+
+    redirector = _redirection.Redirector(
+        {fd: make_callback(k) for k, fd in enumerate(fds)})
+    start = time.perf_counter()
+    writers = [threading.Thread(target=write, args=(fd,)) for fd in fds]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    redirector.close()
+    elapsed = time.perf_counter() - start
+    for fd in fds:
+        os.close(fd)
+    assert sum(received) == total, (received, total)
+    print("{} MiB in {:.3f}s: {:.0f} MiB/s".format(
+        megabytes, elapsed, megabytes / elapsed))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -1,4 +1,12 @@
 if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["rebuild-import-cache"]:
+        # Re-probe the plotly/matlab.engine import order (see _import_order).
+        from ._import_order import rebuild
+        print(rebuild() or "plotly cannot be imported with matlab.engine")
+        sys.exit()
+
     from ipykernel.kernelapp import IPKernelApp
     from ._kernel import MatlabKernel
 
@@ -0,0 +1,145 @@
+"""Pool of pre-started MATLAB engines.
+
+Starting an engine takes 15-30s, so restarts and recovery from a dead engine
+can instead hand over an engine that was started (and bootstrapped) ahead of
+time, while the pool refills itself in the background.
+"""
+
+import threading
+import time
+
+
+def reap(engine, graveyard):
+    """Shut down a (possibly dead) engine without risking a crash at GC.
+
+    Garbage-collecting an engine whose MATLAB already exited leads to an
+    attempt to close it again in ``__del__``, which raises an uncatchable
+    exception.  Closing it explicitly first avoids that; engines that cannot
+    even be closed are kept alive in *graveyard* instead.
+    """
+    try:
+        engine.exit()
+    except Exception:
+        graveyard.append(engine)
+
+
+class EnginePool:
+    """Keep *size* spare engines ready to be handed over.
+
+    Engines are created by calling *start* (which should also bootstrap them)
+    from a background thread.  Spares that stay idle for more than
+    *idle_timeout* seconds (if set) are shut down, and the pool is only
+    refilled on the next call to `acquire`, trading restart latency for memory
+    when the kernel is idle.  At most one engine is started at a time, as
+    concurrent startups only slow each other down (and use an extra license).
+    """
+
+    def __init__(self, start, size, idle_timeout=None, log=None):
+        self._start = start
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._log = log or (lambda message: None)
+        self._spares = []  # List of (engine, time at which it became ready).
+        self._refill = True
+        self._starting = False  # Whether an engine is being started.
+        self._closed = False
+        self._cond = threading.Condition()
+        self.graveyard = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def acquire(self):
+        """Return a ready engine, starting one synchronously if none is.
+
+        If a spare engine is already being started, wait for it instead.
+        """
+        with self._cond:
+            self._refill = True
+            self._cond.notify_all()
+            if not self._spares and self._starting:
+                self._log("Waiting for the spare engine being started")
+                self._cond.wait_for(
+                    lambda: self._spares or not self._starting
+                    or self._closed)
+            if self._spares:
+                engine, _ = self._spares.pop(0)
+                self._log("Handing over a pre-started engine "
+                          "({} spare(s) left)".format(len(self._spares)))
+                return engine
+            self._starting = True
+        self._log("No pre-started engine available, starting one")
+        try:
+            return self._start()
+        finally:
+            with self._cond:
+                self._starting = False
+                self._cond.notify_all()
+
+    def reap(self, engine):
+        reap(engine, self.graveyard)
+
+    def close(self):
+        """Stop refilling and shut down all spare engines.
+        """
+        with self._cond:
+            self._closed = True
+            spares, self._spares = self._spares, []
+            self._cond.notify_all()
+        for engine, _ in spares:
+            self.reap(engine)
+
+    def _next_expiry(self):
+        if not (self._idle_timeout and self._spares):
+            return None
+        return min(ready for _, ready in self._spares) + self._idle_timeout
+
+    def _run(self):
+        while True:
+            expired = []
+            with self._cond:
+                while not self._closed:
+                    if (self._refill and len(self._spares) < self._size
+                            and not self._starting):
+                        self._starting = True
+                        break
+                    expiry = self._next_expiry()
+                    now = time.monotonic()
+                    if expiry is not None and expiry <= now:
+                        expired = [
+                            engine for engine, ready in self._spares
+                            if now - ready >= self._idle_timeout]
+                        self._spares = [
+                            (engine, ready) for engine, ready in self._spares
+                            if now - ready < self._idle_timeout]
+                        self._refill = False
+                        break
+                    self._cond.wait(
+                        None if expiry is None else expiry - now)
+                if self._closed:
+                    return
+            if expired:
+                self._log("Shutting down {} idle spare engine(s)"
+                          .format(len(expired)))
+                for engine in expired:
+                    self.reap(engine)
+                continue
+            try:
+                engine = self._start()
+            except Exception as e:
+                self._log("Failed to start a spare engine: {}".format(e))
+                with self._cond:
+                    self._starting = False
+                    self._cond.notify_all()
+                    # Don't retry in a tight loop.
+                    self._cond.wait(30)
+                continue
+            with self._cond:
+                self._starting = False
+                self._cond.notify_all()
+                if not self._closed:
+                    self._spares.append((engine, time.monotonic()))
+                    self._log("Spare engine ready ({} in pool)"
+                              .format(len(self._spares)))
+                    continue
+            self.reap(engine)
+            return
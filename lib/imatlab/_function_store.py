@@ -0,0 +1,83 @@
+"""Storage of functions defined in cells as files on MATLAB's path.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+import tempfile
+
+from . import _util
+
+
+class FunctionStore:
+    """Write functions extracted from cells to *directory*, only if changed.
+
+    Rewriting unchanged files would force MATLAB to re-parse them (and could
+    race with its cache of the folder), so the contents of each file are
+    tracked by hash and only changed functions are rewritten (atomically).
+
+    Cells run as scripts (see `add_script`) are named after their contents,
+    and thus never rewritten; only the files of the *max_scripts* most
+    recently run ones are kept.
+    """
+
+    def __init__(self, directory, max_scripts=256):
+        self.directory = Path(directory)
+        self._hashes = {}
+        self._scripts = _util.LRUCache(max_scripts)
+
+    def update(self, functions):
+        """Write the changed functions among *functions*.
+
+        *functions* is a list of ``(name, code)`` pairs.  Returns
+        ``(changed, added)``: the names of the functions that need to be
+        cleared from MATLAB's memory (as they were redefined), and the names
+        of newly created files (which require a rehash of the path).
+        """
+        changed = []
+        added = []
+        for name, code in functions:
+            digest = hashlib.sha1(code.encode("utf-8")).hexdigest()
+            path = self.directory / "{}.m".format(name)
+            exists = path.exists()
+            if self._hashes.get(name) == digest and exists:
+                continue
+            self._write(name, code)
+            self._hashes[name] = digest
+            (changed if exists else added).append(name)
+        return changed, added
+
+    def add_script(self, code):
+        """Write *code* to a script named after its contents, if needed.
+
+        Returns ``(name, added, removed)``: the name of the script, whether
+        its file was newly created (which requires a rehash of the path), and
+        the names of the scripts whose files were removed to make room (which
+        need to be cleared from MATLAB's memory).
+        """
+        name = "imatlab_cell_{}".format(
+            hashlib.sha1(code.encode("utf-8")).hexdigest())
+        added = not (self.directory / "{}.m".format(name)).exists()
+        if added:
+            self._write(name, code)
+        removed = []
+        for evicted, _ in self._scripts.put(name, True):
+            try:
+                os.unlink(str(self.directory / "{}.m".format(evicted)))
+            except FileNotFoundError:
+                pass
+            removed.append(evicted)
+        return name, added, removed
+
+    def _write(self, name, code):
+        # Write to a file MATLAB ignores, then rename it in place.
+        fd, tmp = tempfile.mkstemp(
+            dir=str(self.directory), prefix=".{}".format(name),
+            suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(code)
+            os.replace(tmp, str(self.directory / "{}.m".format(name)))
+        except BaseException:
+            os.unlink(tmp)
+            raise
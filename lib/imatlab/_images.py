@@ -0,0 +1,260 @@
+"""Encoding and optimization of exported figures.
+
+Figures exported by the ``memory-*`` exporters are returned by the engine as
+uint8 arrays of interleaved RGB pixels in row-major order (see
+`imatlab_export_figure.m`), which are encoded here without going through the
+filesystem.  PNG encoding only needs `zlib`.
+
+Raster figures then go through a size-reduction pipeline (lossless palette
+conversion and recompression, optional color quantization, optional WebP,
+and downscaling to pixel and byte budgets), which needs Pillow; without it,
+figures are sent as exported.  SVG figures are minified.
+"""
+
+import io
+import math
+import re
+import struct
+import zlib
+
+
+class Options:
+    """Settings of the figure pipeline.
+
+    format: "png" or "webp", the format in which raster figures are sent.
+    colors: if nonzero, quantize raster figures to that many colors.
+    max_pixels: if nonzero, downscale raster figures to at most that many
+      pixels.
+    max_bytes: if nonzero, downscale raster figures until their encoding
+      fits in that many bytes.
+    optimize: whether to losslessly optimize raster figures.
+    """
+
+    def __init__(self, format="png", colors=0, max_pixels=0, max_bytes=0,
+                 optimize=True):
+        self.format = format
+        self.colors = colors
+        self.max_pixels = max_pixels
+        self.max_bytes = max_bytes
+        self.optimize = optimize
+
+
+_DEFAULT_OPTIONS = Options()
+
+
+def pixel_buffer(array):
+    """Return a flat, byte-format memoryview on a matlab.uint8 vector.
+    """
+    try:
+        return memoryview(array).cast("B")
+    except TypeError:
+        # Engines that predate the buffer protocol store the elements of
+        # their arrays in an `array.array`.
+        return memoryview(array._data).cast("B")
+
+
+def _chunk(kind, data):
+    return (struct.pack(">I", len(data)) + kind + data
+            + struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+
+def encode_png(pixels, width, height, level=6):
+    """Encode *pixels* (RGB, row-major, as a bytes-like object) to PNG.
+    """
+    stride = 3 * width
+    if len(pixels) != stride * height:
+        raise ValueError("Expected {} bytes of pixel data, got {}".format(
+            stride * height, len(pixels)))
+    compressor = zlib.compressobj(level)
+    parts = []
+    for y in range(height):
+        # Each row is prefixed by its filter type (0: none).
+        parts.append(compressor.compress(b"\0"))
+        parts.append(compressor.compress(pixels[y * stride:(y + 1) * stride]))
+    parts.append(compressor.flush())
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+        _chunk(b"IDAT", b"".join(parts)),
+        _chunk(b"IEND", b""),
+    ])
+
+
+def _pil():
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+
+_NO_DITHER = 0  # PIL.Image.Dither.NONE.
+
+
+def encode(image, options=_DEFAULT_OPTIONS):
+    """Encode a figure returned by a ``memory-*`` exporter.
+
+    *image* is a dict with the fields ``format`` (``"png"`` or ``"jpeg"``),
+    ``width``, ``height`` and ``pixels``.  Returns ``(mimetype, data,
+    metadata)``.
+    """
+    width = int(image["width"])
+    height = int(image["height"])
+    pixels = pixel_buffer(image["pixels"])
+    Image = _pil()
+    if Image is None:
+        # JPEG encoding is not available; fall back to PNG.
+        return ("image/png",
+                encode_png(pixels, width, height,
+                           level=9 if options.optimize else 6),
+                {})
+    return _process(
+        Image.frombuffer("RGB", (width, height), pixels, "raw", "RGB", 0, 1),
+        image["format"], options)
+
+
+def process(mimetype, data, options=_DEFAULT_OPTIONS):
+    """Run an exported PNG or JPEG figure through the pipeline.
+
+    The figure is only re-encoded if that is needed (to downscale, quantize
+    or convert it) or, for PNG figures, to losslessly optimize it, in which
+    case the smaller of the original and the result is kept.  JPEG figures
+    are only re-encoded when downscaled, as each encoding loses quality.
+
+    Returns ``(mimetype, data, metadata)``.
+    """
+    Image = _pil()
+    if Image is None:
+        return mimetype, data, {}
+    format = mimetype.split("/")[1]
+    image = Image.open(io.BytesIO(data))  # Only reads the header so far.
+    downscale = _too_large(image.size, len(data), options)
+    if format == "jpeg":
+        if not downscale:
+            return mimetype, data, {}
+    elif not (downscale or options.colors or options.optimize
+              or _target_format(format, options) != format):
+        return mimetype, data, {}
+    return _process(image, format, options, original=data)
+
+
+def _too_large(size, nbytes, options):
+    return bool(options.max_pixels and size[0] * size[1] > options.max_pixels
+                or options.max_bytes and nbytes > options.max_bytes)
+
+
+def _target_format(format, options):
+    # JPEG figures stay JPEG; unknown formats are ignored.
+    if format == "jpeg":
+        return format
+    return "webp" if options.format == "webp" else "png"
+
+
+def _process(image, format, options, original=None):
+    Image = _pil()
+    size = image.size
+    if options.max_pixels and size[0] * size[1] > options.max_pixels:
+        image = _scale(image, math.sqrt(
+            options.max_pixels / (size[0] * size[1])))
+    target = _target_format(format, options)
+    if image.mode not in ["RGB", "L", "P"]:
+        image = image.convert("RGB")
+    if options.colors and target != "jpeg":
+        image = image.quantize(
+            colors=int(options.colors), dither=_NO_DITHER)
+    elif options.optimize and image.mode == "RGB" and target == "png":
+        # Figures typically use few colors, in which case a palette
+        # image is identical, but much smaller.
+        colors = image.getcolors(256)
+        if colors is not None:
+            palette = Image.new("P", (1, 1))
+            palette.putpalette(
+                [c for _, color in colors for c in color])
+            image = image.quantize(palette=palette, dither=_NO_DITHER)
+    data = _save(image, target, options)
+    # Downscale until the byte budget is met (or the figure is tiny).
+    for _ in range(8):
+        if not options.max_bytes or len(data) <= options.max_bytes:
+            break
+        if min(image.size) <= 16:
+            break
+        image = _scale(
+            image, min(0.9 * math.sqrt(options.max_bytes / len(data)), 0.9))
+        data = _save(image, target, options)
+    if (original is not None and target == format and image.size == size
+            and len(original) <= len(data)):
+        # Optimization did not help.
+        return "image/" + format, original, {}
+    metadata = {}
+    if image.size != size:
+        # Keep the size at which the figure is displayed.
+        metadata = {"width": size[0], "height": size[1]}
+    return "image/" + target, data, metadata
+
+
+def _scale(image, factor):
+    Image = _pil()
+    if image.mode == "P":
+        image = image.convert("RGB")
+    return image.resize(
+        (max(1, round(image.size[0] * factor)),
+         max(1, round(image.size[1] * factor))),
+        getattr(Image, "Resampling", Image).LANCZOS)
+
+
+def _save(image, format, options):
+    buf = io.BytesIO()
+    if format == "png":
+        image.save(buf, "PNG", optimize=options.optimize)
+    elif format == "webp":
+        # Lossless WebP suits line art better than lossy compression.
+        image.save(buf, "WEBP", lossless=True)
+    elif format == "jpeg":
+        image.convert("RGB").save(buf, "JPEG", quality=90,
+                                  optimize=options.optimize)
+    else:
+        raise ValueError("Unsupported figure format: {}".format(format))
+    return buf.getvalue()
+
+
+def can_thumbnail():
+    return _pil() is not None
+
+
+def thumbnail(data, size=160):
+    """Return a PNG thumbnail (at most *size* pixels wide and high) of an
+    encoded raster image.  Requires Pillow.
+    """
+    Image = _pil()
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((size, size), getattr(Image, "Resampling", Image).LANCZOS)
+    if image.mode not in ["RGB", "L", "P"]:
+        image = image.convert("RGB")
+    buf = io.BytesIO()
+    image.save(buf, "PNG", optimize=True)
+    return buf.getvalue()
+
+
+_SVG_COMMENT_RE = re.compile(r"<!--.*?-->", re.S)
+_SVG_SPACE_RE = re.compile(r">\s+<")
+_SVG_GEOMETRY_RE = re.compile(
+    r'\b(d|points|transform|x|y|x1|y1|x2|y2|cx|cy|r|width|height)="([^"]*)"')
+_SVG_NUMBER_RE = re.compile(r"-?\d+\.\d{4,}")
+
+
+def minify_svg(text):
+    """Minify an SVG figure.
+
+    Comments and whitespace between tags are dropped, and coordinates are
+    rounded to three decimals (i.e., well below a pixel).
+    """
+    text = _SVG_COMMENT_RE.sub("", text)
+    text = _SVG_SPACE_RE.sub("><", text)
+    return _SVG_GEOMETRY_RE.sub(
+        lambda m: '{}="{}"'.format(
+            m.group(1), _SVG_NUMBER_RE.sub(_round, m.group(2))),
+        text)
+
+
+def _round(match):
+    return "{:.3f}".format(float(match.group())).rstrip("0").rstrip(".")
@@ -0,0 +1,104 @@
+"""Cached detection of a working import order for plotly and matlab.engine.
+
+MATLAB's engine plays LD_PRELOAD tricks that can make the import of plotly (or
+of its dependencies) fail depending on which of the two modules is imported
+first.  Finding a working order requires importing both in fresh interpreters,
+which takes several seconds, so the result is cached on disk, keyed on
+everything that can change the outcome.  Run ``python -mimatlab
+rebuild-import-cache`` to force a new probe.
+"""
+
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+
+try:
+    import importlib.metadata as _importlib_metadata
+except ImportError:
+    import importlib_metadata as _importlib_metadata
+
+
+PLOTLY_FIRST = "plotly, matlab.engine"
+MATLAB_FIRST = "matlab.engine, plotly"
+# Neither order works; plotly is unavailable.
+NO_PLOTLY = ""
+
+
+def _cache_path():
+    return Path(os.environ.get(
+        "IMATLAB_CACHE_DIR", Path.home() / ".imatlab")) / "import_order.json"
+
+
+def _dist_version(*names):
+    for name in names:
+        try:
+            return _importlib_metadata.version(name)
+        except _importlib_metadata.PackageNotFoundError:
+            pass
+    return ""
+
+
+def cache_key():
+    """Return the string identifying the current interpreter setup.
+    """
+    return json.dumps({
+        "executable": sys.executable,
+        # The engine has been distributed under both names.
+        "matlabengine": _dist_version("matlabengine", "matlabengineforpython"),
+        "plotly": _dist_version("plotly"),
+        "ld_preload": os.environ.get("LD_PRELOAD", ""),
+    }, sort_keys=True)
+
+
+def probe():
+    """Find a working import order by importing in fresh interpreters.
+    """
+    for order in [PLOTLY_FIRST, MATLAB_FIRST]:
+        if subprocess.call([sys.executable, "-c", "import " + order],
+                           stderr=subprocess.DEVNULL) == 0:
+            return order
+    return NO_PLOTLY
+
+
+def _load():
+    try:
+        with _cache_path().open() as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _store(key, order):
+    path = _cache_path()
+    cache = _load()
+    cache[key] = order
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write atomically, as several kernels may start simultaneously.
+        fd, tmp = tempfile.mkstemp(dir=str(path.parent), suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(cache, file, indent=2, sort_keys=True)
+        os.replace(tmp, str(path))
+    except OSError:
+        pass  # Caching is an optimization only.
+
+
+def rebuild():
+    """Probe the import order and store it in the cache.
+    """
+    order = probe()
+    _store(cache_key(), order)
+    return order
+
+
+def get():
+    """Return the cached import order, probing if there is no cached value.
+    """
+    order = _load().get(cache_key())
+    if order in [PLOTLY_FIRST, MATLAB_FIRST, NO_PLOTLY]:
+        return order
+    return rebuild()
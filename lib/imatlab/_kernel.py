@@ -1,13 +1,15 @@
 import base64
-from contextlib import ExitStack
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 import json
 import os
 from pathlib import Path
 import re
-import subprocess
+import shutil
 import sys
 import tempfile
+import threading
 import time
 from tempfile import TemporaryDirectory
 import time
@@ -18,21 +20,21 @@ import weakref
 from xml.etree import ElementTree as ET
 
 import ipykernel.kernelspec
+from ipykernel.comm import CommManager
 from ipykernel.kernelbase import Kernel
 import IPython
 from IPython.core.interactiveshell import InteractiveShell
 
-# Work around LD_PRELOAD tricks played by MATLAB by looking for a working
-# import order.
-if subprocess.call(
-        [sys.executable, "-c", "import plotly, matlab.engine"],
-        stderr=subprocess.DEVNULL) == 0:
+from . import _import_order
+
+# Work around LD_PRELOAD tricks played by MATLAB by using a working import
+# order (probed once, then cached).
+_order = _import_order.get()
+if _order == _import_order.PLOTLY_FIRST:
     import plotly
     import matlab.engine
     from matlab.engine import EngineError, MatlabExecutionError
-elif subprocess.call(
-        [sys.executable, "-c", "import matlab.engine, plotly"],
-        stderr=subprocess.DEVNULL) == 0:
+elif _order == _import_order.MATLAB_FIRST:
     import matlab.engine
     from matlab.engine import EngineError, MatlabExecutionError
     import plotly
@@ -42,9 +44,12 @@ else:
     plotly = None
     warnings.warn(
         "Failed to import both matlab.engine and plotly in the same process; "
-        "plotly output is unavailable.")
+        "plotly output is unavailable.  If this is no longer the case, run "
+        "`python -mimatlab rebuild-import-cache`.")
 
-from . import _redirection, __version__
+from . import (
+    _engine_pool, _function_store, _images, _live_figures, _redirection,
+    _streams, _syntax, _util, _workspace, __version__)
 
 # debugpy.listen(5678) # ensure that this port is the same as the one in your launch.json
 # print("Waiting for debugger attach")
@@ -71,6 +76,55 @@ ipykernel.kernelspec.get_kernel_dict = lambda extra_arguments=None, python_argum
     "language": "matlab",
 }
 
+_RESOURCES_PATH = Path(__file__).with_name("res")
+# Environment variables controlling the kernel that can also be changed from
+# MATLAB (with `setenv`); their MATLAB-side values, if set, are reported back
+# by `imatlab_run_cell` after each cell, and override the kernel's own (which
+# differ when connected to a shared engine).
+_SETTINGS = ["IMATLAB_DEBUG_PROBE_INTERVAL", "IMATLAB_EXECUTION_MODE",
+             "IMATLAB_OUTPUT_MAX_BYTES", "IMATLAB_OUTPUT_MAX_LINES",
+             "IMATLAB_OUTPUT_SPILL_DIR", "IMATLAB_PROGRESS_INTERVAL",
+             "IMATLAB_FIGURE_FORMAT", "IMATLAB_FIGURE_COLORS",
+             "IMATLAB_FIGURE_MAX_PIXELS", "IMATLAB_FIGURE_MAX_BYTES",
+             "IMATLAB_FIGURE_OPTIMIZE", "IMATLAB_LIVE_FIGURES",
+             "IMATLAB_FIGURE_GALLERY", "IMATLAB_TRANSFER_MMAP_BYTES",
+             "IMATLAB_TABLE_CHUNK_ROWS", "IMATLAB_DISPLAY_MAX_ROWS",
+             "IMATLAB_DISPLAY_MAX_COLS"]
+
+# Clicking a thumbnail swaps it with the full-size figure, requested from the
+# kernel through an `imatlab.gallery` comm (in frontends that expose the
+# kernel to outputs, i.e. the classic notebook).
+_GALLERY_TEMPLATE = """\
+<div id="{id}">{images}</div>
+<script>
+(function() {{
+  var gallery = document.getElementById("{id}");
+  var kernel = window.Jupyter && Jupyter.notebook && Jupyter.notebook.kernel;
+  if (!gallery || !kernel) {{ return; }}
+  var comm = kernel.comm_manager.new_comm("imatlab.gallery", {{}});
+  comm.on_msg(function(msg) {{
+    var data = msg.content.data;
+    var img = gallery.querySelector('[data-key="' + data.key + '"]');
+    if (!img) {{ return; }}
+    if (data.error) {{ img.title = data.error; return; }}
+    img.dataset.thumbnail = img.src;
+    img.src = "data:" + data.mimetype + ";base64," + data.data;
+  }});
+  gallery.addEventListener("click", function(event) {{
+    var img = event.target;
+    if (!img.dataset.key) {{ return; }}
+    if (img.dataset.thumbnail) {{
+      img.src = img.dataset.thumbnail;
+      delete img.dataset.thumbnail;
+    }} else {{
+      comm.send({{key: img.dataset.key}});
+    }}
+  }});
+}})();
+</script>
+"""
+
+
 class MatlabHistory:
     # The MATLAB GUI relies on `History.xml` (which uses a ridiculously fragile
     # parser); the command line (-nodesktop) interface on `history.m`.  We read
@@ -139,21 +193,31 @@ class MatlabKernel(Kernel):
         kwargs['background'] = True
         return self._engine.builtin(*args, **kwargs)
 
-    def _execute_with_debug_detection(self, code, nargout=0, stdout=None, stderr=None):
+    def _execute_with_debug_detection(self, func, *args, nargout=0, stdout=None, stderr=None,
+                                      poll=None, poll_interval=None):
         """Execute code asynchronously with detection for when debugging completes.
 
-        This handles the case where MATLAB enters the debugger during execution.
-        When the user interacts with the debugger via MATLAB Desktop and then
-        exits (e.g., via dbquit), this method detects that MATLAB is responsive
-        again and returns, even if the original Future doesn't properly complete.
+        Completion is signalled by a waiter thread blocking on the engine's
+        Future, so that short cells return immediately and long computations
+        are not disturbed by extra engine calls.
+
+        This also handles the case where MATLAB enters the debugger during
+        execution.  When the user interacts with the debugger via MATLAB
+        Desktop and then exits (e.g., via dbquit), the original Future may not
+        properly complete.  MATLAB is then only probed upon an explicit
+        signal: when the kernel is interrupted, or periodically if
+        IMATLAB_DEBUG_PROBE_INTERVAL is set.
 
         Args:
-            code: MATLAB code to execute
+            func: Name of the MATLAB function to call
+            *args: Arguments to the function
             nargout: Number of output arguments (default 0)
             stdout: StringIO for stdout capture (Windows)
             stderr: StringIO for stderr capture (Windows)
+            poll: Called every poll_interval seconds while waiting
 
-        Returns True if execution completed normally, False if there was an error.
+        Returns the function's result, or None if completion was detected
+        without a result being available.
         Raises exceptions for engine errors.
         """
         # Build kwargs for the async call
@@ -164,95 +228,137 @@ class MatlabKernel(Kernel):
             call_kwargs['stderr'] = stderr
 
         # Execute the code asynchronously
-        future = self._call_async("eval", code, **call_kwargs)
+        future = getattr(self._engine, func)(
+            *args, background=True, **call_kwargs)
+
+        done = threading.Event()
+        outcome = {}
 
-        poll_interval = 0.1  # seconds between done() checks
-        probe_interval = 2.0  # seconds between probe attempts
-        last_probe_time = time.time()
+        def wait():
+            try:
+                outcome["result"] = future.result()
+            except BaseException as e:
+                outcome["error"] = e
+            done.set()
+
+        threading.Thread(target=wait, daemon=True).start()
+
+        probe_interval = self._number_setting(
+            "IMATLAB_DEBUG_PROBE_INTERVAL", 0) or None
+        next_probe = (time.monotonic() + probe_interval
+                      if probe_interval else None)
+        next_poll = time.monotonic() + poll_interval if poll else None
         desktop_shown = False  # Track if we've shown desktop during this execution
 
         while True:
-            # Check if the main execution completed
-            if future.done():
-                # Get result to propagate any exceptions
-                self._debug("Future marked done, getting result")
-                try:
-                    result = future.result()
-                    self._debug(f"future.result() returned: {result}")
-                    return True
-                except EngineError as e:
-                    # After debugging, future.result() may raise EngineError even though
-                    # execution completed. If MATLAB is still responsive (which we know
-                    # because we're here), treat this as success.
-                    self._debug(f"future.result() raised EngineError (likely from debugging): {e}")
-                    self._debug("Treating as successful completion since future is done")
-                    return True
-                except Exception as e:
-                    self._debug(f"future.result() raised exception: {type(e).__name__}: {e}")
-                    raise
-
-            time.sleep(poll_interval)
-
-            # Periodically try to probe MATLAB to see if it's responsive
-            # This handles the case where the user exits the debugger but
-            # the Future doesn't properly complete
-            current_time = time.time()
-            if current_time - last_probe_time >= probe_interval:
-                last_probe_time = current_time
-                self._debug("Probing MATLAB responsiveness...")
+            now = time.monotonic()
+            timeouts = [next_poll - now if next_poll else None,
+                        next_probe - now if next_probe else None]
+            # Always bounded, as untimed waits cannot be interrupted by
+            # Ctrl-C on Windows (but polls and probes keep their own pace).
+            timeouts = [max(t, 0) for t in timeouts if t is not None] + [0.2]
+            try:
+                finished = done.wait(min(timeouts))
+                interrupted = False
+            except KeyboardInterrupt:
+                finished = done.is_set()
+                interrupted = True
+            if finished:
+                return self._future_outcome(outcome)
+            if not interrupted:
+                if next_poll is not None and time.monotonic() >= next_poll:
+                    poll()
+                    next_poll = time.monotonic() + poll_interval
+                if next_probe is None or time.monotonic() < next_probe:
+                    continue
+                next_probe = time.monotonic() + probe_interval
+
+            # Explicit signal: check whether MATLAB is responsive, in which
+            # case the Future is stuck (likely after debugging).
+            state = self._probe_matlab(future)
+            if state == "done":
+                while not done.wait(0.2):
+                    pass
+                return self._future_outcome(outcome)
+            elif state == "stuck":
                 try:
-                    # Try a quick background probe with a short timeout
-                    # If MATLAB is in debug mode, this will block/timeout
-                    # If MATLAB is responsive, this will complete quickly
-                    probe_future = self._engine.eval("1", background=True)
-                    probe_future.result(timeout=0.5)
-
-                    self._debug("MATLAB is responsive to probe")
-
-                    # If we get here, MATLAB is responsive
-                    # Check again if main future is done (race condition)
-                    if future.done():
-                        self._debug("Main future now done after probe")
-                        future.result()
-                        return True
-
-                    # MATLAB is responsive but main future isn't done
-                    # This likely means the future is "stuck" after debugging
-                    # Check if we're actually still in debug mode
+                    future.cancel()
+                except:
+                    pass
+                return None
+            elif state == "debugging":
+                if not desktop_shown:
+                    # MATLAB is in debug mode - show desktop once so user can interact
+                    desktop_shown = True
                     try:
-                        self._debug("Checking if still in debug mode...")
-                        in_debug = self._engine.is_in_debug_mode()
-                        self._debug(f"is_in_debug_mode returned: {in_debug}")
-
-                        if in_debug and not desktop_shown:
-                            # MATLAB is in debug mode - show desktop once so user can interact
-                            desktop_shown = True
-                            try:
-                                self._debug("In debug mode, attempting to show desktop...")
-                                # Call desktop asynchronously with nargout=0 to avoid varargout error
-                                desktop_future = self._engine.desktop(nargout=0, background=True)
-                                self._debug("Desktop command sent")
-                            except Exception as desktop_err:
-                                self._debug(f"Failed to show desktop: {desktop_err}")
-
-                        if not in_debug:
-                            # Not in debug mode, MATLAB responsive, but future not done
-                            # The execution likely completed but future didn't update
-                            self._debug("MATLAB responsive, not in debug mode, but future not done. Completing.")
-                            try:
-                                future.cancel()
-                            except:
-                                pass
-                            return True
-                    except Exception as e:
-                        # Couldn't check debug mode, assume we should wait
-                        self._debug(f"Exception checking debug mode: {e}")
-                        pass
-
+                        self._debug("In debug mode, attempting to show desktop...")
+                        # Call desktop asynchronously with nargout=0 to avoid varargout error
+                        self._engine.desktop(nargout=0, background=True)
+                        self._debug("Desktop command sent")
+                    except Exception as desktop_err:
+                        self._debug(f"Failed to show desktop: {desktop_err}")
+            elif interrupted:
+                # MATLAB is busy running the cell: interrupt it.
+                self._debug("Interrupted while MATLAB is busy, cancelling")
+                try:
+                    future.cancel()
                 except Exception as e:
-                    # Probe timed out or failed - MATLAB is busy (likely debugging)
-                    self._debug(f"Probe failed (MATLAB busy/debugging): {e}")
-                    pass
+                    self._debug(f"Failed to cancel execution: {e}")
+                raise KeyboardInterrupt
+
+    def _future_outcome(self, outcome):
+        if "error" not in outcome:
+            self._debug(f"future.result() returned: {outcome['result']}")
+            return outcome["result"]
+        e = outcome["error"]
+        if isinstance(e, EngineError):
+            # After debugging, future.result() may raise EngineError even though
+            # execution completed. If MATLAB is still responsive (which we know
+            # because we're here), treat this as success.
+            self._debug(f"future.result() raised EngineError (likely from debugging): {e}")
+            self._debug("Treating as successful completion since future is done")
+            return None
+        self._debug(f"future.result() raised exception: {type(e).__name__}: {e}")
+        raise e
+
+    def _probe_matlab(self, future):
+        """Check whether MATLAB is responsive while *future* is pending.
+
+        Returns "done" if the future completed meanwhile, "stuck" if MATLAB is
+        responsive and not debugging (the execution completed but the future
+        did not update), "debugging" if MATLAB is paused in the debugger, and
+        "busy" if MATLAB does not respond (still running, or debugging).
+        """
+        self._debug("Probing MATLAB responsiveness...")
+        try:
+            # Try a quick background probe with a short timeout
+            # If MATLAB is in debug mode, this will block/timeout
+            # If MATLAB is responsive, this will complete quickly
+            probe_future = self._engine.eval("1", background=True)
+            probe_future.result(timeout=0.5)
+        except Exception as e:
+            # Probe timed out or failed - MATLAB is busy (likely debugging)
+            self._debug(f"Probe failed (MATLAB busy/debugging): {e}")
+            return "busy"
+        self._debug("MATLAB is responsive to probe")
+        # Check again if main future is done (race condition)
+        if future.done():
+            self._debug("Main future now done after probe")
+            return "done"
+        try:
+            self._debug("Checking if still in debug mode...")
+            in_debug = self._engine.is_in_debug_mode()
+            self._debug(f"is_in_debug_mode returned: {in_debug}")
+        except Exception as e:
+            # Couldn't check debug mode, assume we should wait
+            self._debug(f"Exception checking debug mode: {e}")
+            return "busy"
+        if in_debug:
+            return "debugging"
+        # Not in debug mode, MATLAB responsive, but future not done
+        # The execution likely completed but future didn't update
+        self._debug("MATLAB responsive, not in debug mode, but future not done. Completing.")
+        return "stuck"
 
     @property
     def language_info(self):
@@ -275,80 +381,193 @@ class MatlabKernel(Kernel):
         super().__init__(*args, **kwargs)
         self._silent = False
         self._debug_mode = os.environ.get("IMATLAB_DEBUG", "").lower() in ("1", "true", "yes")
-
-        # console, qtconsole uses `kernel-$pid`, notebook uses `kernel-$uuid`.
-        self._has_console_frontend = bool(re.match(
-            r"\Akernel-\d+\Z",
-            Path(self.config["IPKernelApp"]["connection_file"]).stem))
-
-        if os.name == "posix":
-            with ExitStack() as stack:
-                for name in ["stdout", "stderr"]:
-                    stream = getattr(sys, "__{}__".format(name))
-                    def callback(data, *, _name=name, _stream=stream):
-                        if not self._silent:
-                            self._send_stream(
-                                _name, data.decode(_stream.encoding))
-                    stack.enter_context(
-                        _redirection.redirect(stream.fileno(), callback))
-                weakref.finalize(self, stack.pop_all().close)
-
+        self._startup_timeline = []
+        startup_start = time.perf_counter()
+        # All stream output goes through the batcher, which sends it from a
+        # single thread, then through the progress compactor, which turns
+        # self-overwriting lines into updated displays, and through the guard,
+        # which caps the output of each cell.
+        self._output_guard = _streams.OutputGuard(self._publish_stream)
+        self._progress = _streams.ProgressCompactor(
+            self._output_guard.send, self._publish_progress)
+        self._streams = _streams.StreamBatcher(
+            self._progress.send, log=self.log.error)
+        weakref.finalize(self, self._streams.close)
+        # Figures are encoded in parallel with the export of the next ones.
+        self._encoder = ThreadPoolExecutor(
+            max_workers=min(4, os.cpu_count() or 1),
+            thread_name_prefix="imatlab-encoder")
+        self._figure_displays = _util.DisplayTracker("imatlab-figure")
+        self._plotly_initialized = False
+
+        def mark(phase):
+            self._startup_timeline.append(
+                (phase, time.perf_counter() - startup_start))
+
+        # Start (or connect to) the engine in the background first, as this is
+        # by far the slowest step; the Python-side setup proceeds meanwhile.
         self._dead_engines = []
         engine_name = os.environ.get("IMATLAB_CONNECT")
         print("Launching MATLAB")
-        self.log.error("Launching MATLAB engine")
         if engine_name:
             if re.match(r"\A(?a)[a-zA-Z]\w*\Z", engine_name):
-                self._engine = matlab.engine.connect_matlab(engine_name)
+                engine_future = matlab.engine.connect_matlab(
+                    engine_name, background=True)
             else:
-                self._engine = matlab.engine.connect_matlab()
+                engine_future = matlab.engine.connect_matlab(background=True)
         else:
-            self._engine = matlab.engine.start_matlab()
-        # self._history = MatlabHistory(Path(self._call("prefdir")))
+            engine_future = matlab.engine.start_matlab(background=True)
+        mark("engine launch requested")
 
-        self.log.error("Adding resources to MATLAB path")
-        resources_path = str(Path(sys.modules[__name__.split(".")[0]].__file__).
-            with_name("res"))
-        self._engine.addpath(resources_path,"-end")
-        self.log.error("DONE Adding resources to MATLAB path")
-
-        # set env var to let Matlab code know its in Jupyter kernel
-        self._engine.setenv("JUPYTER_KERNEL", "imatlab", nargout=0)
+        # console, qtconsole uses `kernel-$pid`, notebook uses `kernel-$uuid`.
+        self._has_console_frontend = bool(re.match(
+            r"\Akernel-\d+\Z",
+            Path(self.config["IPKernelApp"]["connection_file"]).stem))
 
-        try_startup_code = (
-            "try, startupJupyter, catch, end"
-        )
-        self.log.error("Running startupJupyter")
-        self._call("eval", try_startup_code, nargout=0)
-        self.log.error("DONE Running startupJupyter")
+        self._redirector = None
+        if os.name == "posix":
+            callbacks = {}
+            for name in ["stdout", "stderr"]:
+                stream = getattr(sys, "__{}__".format(name))
+                def callback(data, *, _name=name, _stream=stream):
+                    if not self._silent:
+                        self._streams.write(_name, data, _stream.encoding)
+                callbacks[stream.fileno()] = callback
+            self._redirector = _redirection.Redirector(callbacks)
+            weakref.finalize(self, self._redirector.close)
+        mark("stream redirection")
 
         # Create a temporary directory for inline function definitions
         # This directory persists for the lifetime of the kernel
         self._temp_func_dir = tempfile.mkdtemp(prefix="imatlab_funcs_")
-        self.log.error(f"Created temp function directory: {self._temp_func_dir}")
+        self._function_store = _function_store.FunctionStore(
+            self._temp_func_dir)
         self._debug(f"Function storage directory: {self._temp_func_dir}")
+        mark("function directory")
 
-        # Add the temp directory to MATLAB's path so functions are accessible
-        self._engine.addpath(self._temp_func_dir, "-begin", nargout=0)
-        self.log.error("Added temp function directory to MATLAB path")
+        self._engine = engine_future.result()
+        mark("engine ready")
+        # self._history = MatlabHistory(Path(self._call("prefdir")))
+
+        self._bootstrap_engine(self._engine, self._temp_func_dir)
+        mark("bootstrap")
+
+        self.log.info("MATLAB kernel startup timeline: " + ", ".join(
+            "{} at {:.2f}s".format(phase, elapsed)
+            for phase, elapsed in self._startup_timeline))
+
+        # Optionally keep pre-started engines around for restarts and for
+        # recovery from a dead engine.
+        pool_size = int(os.environ.get("IMATLAB_ENGINE_POOL_SIZE") or 0)
+        idle_timeout = float(
+            os.environ.get("IMATLAB_ENGINE_POOL_IDLE_TIMEOUT") or 0)
+        self._engine_pool = _engine_pool.EnginePool(
+            self._start_spare_engine, pool_size, idle_timeout or None,
+            log=self.log.info) if pool_size > 0 else None
 
         self._do_execute_first = True
+        self._settings = self._environment_settings()
+        # Maps cell hashes to `_extract_functions` results.
+        self._extract_cache = _util.LRUCache(256)
+
+        # Full-size figures shown as thumbnails in a gallery, fetched by the
+        # frontend on demand through an `imatlab.gallery` comm.
+        self._gallery = _util.LRUCache(
+            float(os.environ.get("IMATLAB_GALLERY_MAX_BYTES") or 256e6),
+            sizeof=lambda entry: len(entry[1]))
+        self.comm_manager = CommManager(parent=self, kernel=self)
+        for msg_type in ["comm_open", "comm_msg", "comm_close"]:
+            self.shell_handlers[msg_type] = getattr(
+                self.comm_manager, msg_type)
+        self.comm_manager.register_target(
+            "imatlab.gallery", self._open_gallery_comm)
+
+        self.comm_manager.register_target(
+            "imatlab.inspector", self._open_inspector_comm)
+        # The output of `whos`, as of an execution count.
+        self._inspector_cache = (None, [])
+
+        # Arrays transferred by the `%get` and `%put` magics.
+        self.user_ns = {}
+
+    def _start_spare_engine(self):
+        engine = matlab.engine.start_matlab()
+        self._bootstrap_engine(engine, None)
+        return engine
+
+    def _replace_engine(self):
+        """Switch to a fresh, bootstrapped engine, from the pool if enabled.
+        """
+        if self._engine_pool:
+            self._engine = self._engine_pool.acquire()
+            self._engine.addpath(self._temp_func_dir, "-begin", nargout=0)
+        else:
+            self._engine = matlab.engine.start_matlab()
+            self._bootstrap_engine(self._engine, self._temp_func_dir)
+        # Settings changed from the previous engine do not carry over.
+        self._settings = self._environment_settings()
+
+    def _reap_engine(self, engine):
+        _engine_pool.reap(engine, self._dead_engines)
+
+    @staticmethod
+    def _bootstrap_engine(engine, func_dir):
+        """Run all MATLAB-side initialization in a single engine call.
+
+        This adds the resources folder to the path, then lets
+        `imatlab_bootstrap` set `JUPYTER_KERNEL`, run `startupJupyter` and add
+        *func_dir* to the path.
+        """
+        def quote(s):
+            return "'{}'".format(str(s).replace("'", "''"))
+        engine.builtin(
+            "eval",
+            "addpath({}, '-end'); imatlab_bootstrap({});".format(
+                quote(_RESOURCES_PATH), quote(func_dir or "")),
+            nargout=0)
+
+    @staticmethod
+    def _environment_settings():
+        return {name: os.environ.get(name, "") for name in _SETTINGS}
+
+    def _setting(self, name, default=""):
+        """Return the value of a setting from `_SETTINGS`, as last seen in MATLAB
+        (if set there), or else in the kernel's environment.
+        """
+        return self._settings.get(name) or default
+
+    def _number_setting(self, name, default):
+        try:
+            return float(self._setting(name, default))
+        except ValueError:
+            return float(default)
 
     def _send_stream(self, stream, text):
+        self._streams.write_text(stream, text)
+
+    def _publish_stream(self, stream, text):
         self.send_response(self.iopub_socket,
                            "stream",
                            {"name": stream, "text": text})
 
+    def _publish_progress(self, text, display_id, update):
+        self.send_response(self.iopub_socket,
+                           "update_display_data" if update else "display_data",
+                           {"data": {"text/plain": text},
+                            "metadata": {},
+                            "transient": {"display_id": display_id}})
+
     def _debug(self, message):
         """Send debug message to stderr if IMATLAB_DEBUG is enabled."""
         if self._debug_mode:
             self._send_stream("stderr", f"DEBUG: {message}\n")
 
     def _extract_functions(self, code):
-        """Extract outer function definitions from MATLAB code using mtree.
+        """Extract outer function definitions from MATLAB code.
 
-        Uses MATLAB's built-in mtree parser to robustly parse the code and extract
-        function definitions.
+        The code is first parsed on the Python side, falling back to MATLAB's
+        built-in mtree parser if the Python parser is unsure.  Results are
+        cached by cell hash.
 
         Args:
             code: String containing MATLAB code
@@ -359,6 +578,31 @@ class MatlabKernel(Kernel):
             - functions: List of (function_name, function_code) tuples
             - error_msg: Error message string if parsing failed, None otherwise
         """
+        key = hashlib.sha1(code.encode("utf-8")).digest()
+        cached = self._extract_cache.get(key)
+        if cached is not None:
+            self._debug("Using cached function extraction")
+            return cached
+        parsed = _syntax.extract_functions(code)
+        if parsed is not None:
+            remaining_code, functions = parsed
+            self._debug(f"Python parser found {len(functions)} function(s)")
+            result = remaining_code, functions, None
+        else:
+            self._debug("Python parser unsure, falling back to mtree")
+            result = self._extract_functions_mtree(code)
+            if result is None:
+                # Fall back to returning original code with no functions
+                return code, [], None
+        self._extract_cache.put(key, result)
+        return result
+
+    def _extract_functions_mtree(self, code):
+        """Extract outer function definitions from MATLAB code using mtree.
+
+        Uses MATLAB's built-in mtree parser to robustly parse the code and extract
+        function definitions.  Returns None if the MATLAB helper failed.
+        """
         try:
             self._debug("Calling MATLAB imatlab_extract_functions...")
 
@@ -393,15 +637,20 @@ class MatlabKernel(Kernel):
             self._debug(f"Error extracting functions with mtree: {e}")
             import traceback
             self._debug(traceback.format_exc())
-            # Fall back to returning original code with no functions
-            return code, [], None
+            return None
 
-    def _send_display_data(self, data, metadata):
+    def _send_display_data(self, data, metadata, display_id=None,
+                           update=False):
+        # Keep the display in order with the output that preceded it.
+        self._streams.flush()
         # ZMQDisplayPublisher normally handles the conversion of `None`
         # metadata to {}.
+        content = {"data": data, "metadata": metadata or {}}
+        if display_id is not None:
+            content["transient"] = {"display_id": display_id}
         self.send_response(self.iopub_socket,
-                           "display_data",
-                           {"data": data, "metadata": metadata or {}})
+                           "update_display_data" if update else "display_data",
+                           content)
 
     def do_execute(
             self, code, silent, store_history=True,
@@ -427,28 +676,76 @@ class MatlabKernel(Kernel):
         if error_msg:
             self._debug("Syntax error detected, aborting execution")
             self._send_stream("stderr", f"\n{error_msg}\n")
+            self._streams.flush()
             return {"status": "error",
                     "execution_count": self.execution_count,
                     "ename": "SyntaxError",
                     "evalue": "Failed to parse cell code",
                     "traceback": [error_msg]}
 
+        magics = _workspace.parse_magics(code)
+        if not self._run_magics("put", magics):
+            self._streams.flush()
+            return {"status": "error",
+                    "execution_count": self.execution_count,
+                    "ename": "",
+                    "evalue": "",
+                    "traceback": []}
+
+        # Functions that were redefined must be cleared from MATLAB's memory,
+        # and new files require a path rehash; this is done in
+        # `imatlab_run_cell`.
+        cleared_functions = []
+        rehash = False
         if len(functions) > 0:
             self._debug(f"Extracted {len(functions)} function(s) from cell")
-            for func_name, func_code in functions:
-                # Write function to .m file in temp directory
-                func_file_path = os.path.join(self._temp_func_dir, f"{func_name}.m")
-                try:
-                    with open(func_file_path, 'w') as f:
-                        f.write(func_code)
-                    self._debug(f"Saved function {func_name} to {func_file_path}")
-                except Exception as e:
-                    self._debug(f"ERROR: Failed to save function {func_name}: {e}")
+            try:
+                cleared_functions, added = self._function_store.update(
+                    functions)
+                rehash = bool(added)
+                self._debug(f"Changed functions: {cleared_functions}, "
+                            f"new functions: {added}")
+            except Exception as e:
+                self._debug(f"ERROR: Failed to save functions: {e}")
 
             # Use the remaining code (without function definitions) for execution
             code = remaining_code
             self._debug(f"Remaining code after function extraction: {code[:100]}...")
 
+        # A variable that the cell ends with is displayed by
+        # `imatlab_display_value`, which only sends a bounded preview of it;
+        # anything else (e.g. `figure` or `plot(x)`) is run as written.
+        display_code = ""
+        max_rows = int(self._number_setting("IMATLAB_DISPLAY_MAX_ROWS", 20))
+        max_cols = int(self._number_setting("IMATLAB_DISPLAY_MAX_COLS", 20))
+        split = (_syntax.trailing_expression(code)
+                 if max_rows > 0 and max_cols > 0 else None)
+        if split:
+            code, name, expression = split
+            display_code = (
+                "if exist('{name}', 'var')\n"
+                "imatlab_display_value('capture', '{quoted}', {rows}, "
+                "{cols})\n"
+                "else\n{expression}\nend\n".format(
+                    name=name, quoted=expression.replace("'", "''"),
+                    expression=expression, rows=max_rows, cols=max_cols))
+
+        if (self._setting("IMATLAB_EXECUTION_MODE", "eval") == "script"
+                and code.strip()):
+            # Run the cell from a script file named after its contents, so
+            # that it is parsed once and goes through MATLAB's file-based
+            # execution engine rather than `eval`.
+            try:
+                script, added, removed = self._function_store.add_script(
+                    code)
+            except Exception as e:
+                self._debug(f"ERROR: Failed to save cell script: {e}")
+            else:
+                rehash = rehash or added
+                # Scripts whose files were removed may still be cached.
+                cleared_functions = cleared_functions + removed
+                code = script
+
         # self.log.error("Begin do_execute command")
 
         status = "ok"
@@ -460,128 +757,125 @@ class MatlabKernel(Kernel):
         # interacts poorly with the engine.
         #self._call("dbclear", "all", nargout=0)
 
-        # here we set and then clear an environment variable that indicates the
-        # code is being run within Jupyter (and not the desktop)
-        code_pre = "imatlab_pre_execute();"
-        code_post = "imatlab_post_execute();"
-
         # Don't include the "Error using eval" before each output.
         # This does not distinguish between `x` and `eval('x')` (with `x`
         # undefined), so a better solution would be preferred.
         try_code = (
-            "{code_pre} "
             "try, {code}\n" # Newline needed as code may end with a comment.
-            r"catch {me}; fprintf('%s\n', {me}.getReport); clear {me}; {code_post} end;"
-            " {code_post}"
-            .format(code=code, code_pre=code_pre, code_post=code_post,
+            "{display}"
+            r"catch {me}; fprintf('%s\n', {me}.getReport); clear {me}; end;"
+            .format(code=code, display=display_code,
                     me="ME{}".format(str(uuid.uuid4()).replace("-", ""))))
-
-        no_try_code = (
-            "{code_pre} {code}\n {code_post}"
-            .format(code=code, code_pre=code_pre, code_post=code_post))
+        # Used instead if "dbstop if error" is set, so that the debugger
+        # catches errors.
+        no_try_code = "{code}\n{display}".format(
+            code=code, display=display_code)
+
+        # Live snapshots are only tracked within an execution, as the
+        # frontend clears the outputs of the cell being executed.
+        self._figure_displays.reset()
+        self._progress.configure(
+            0 if self._has_console_frontend
+            else self._number_setting("IMATLAB_PROGRESS_INTERVAL", 0.25))
+        self._output_guard.start(
+            self._number_setting("IMATLAB_OUTPUT_MAX_BYTES", 1000000),
+            self._number_setting("IMATLAB_OUTPUT_MAX_LINES", 10000),
+            self._setting("IMATLAB_OUTPUT_SPILL_DIR",
+                          os.path.join(tempfile.gettempdir(), "imatlab_output")),
+            "cell{}".format(self.execution_count))
 
         if os.name == "posix":
-            try:
-                # call wrapped in try / catch if we're not debugging
-                isdbg = self._engine.is_dbstop_if_error()
-            except (SyntaxError, MatlabExecutionError, KeyboardInterrupt):
-                isdbg = False
-                resources_path = str(Path(sys.modules[__name__.split(".")[0]].__file__).
-                    with_name("res"))
-                self._send_stream("stderr",
-                    "is_dbstop_if_error.m from imatlab resources folder (%s) is not found on path\n" % (resources_path, ))
-
-            try:
-                code_to_run = no_try_code if isdbg else try_code
-                self._execute_with_debug_detection(code_to_run, nargout=0)
-                self._debug("_execute_with_debug_detection returned successfully")
-            except (SyntaxError, MatlabExecutionError, KeyboardInterrupt) as e:
-                self._debug(f"Caught exception (SyntaxError/MatlabExecutionError/KeyboardInterrupt): {e}")
-                status = "error"
-            except EngineError as engine_error:
-                # Check whether the engine died.
-                try:
-                    self._call("eval", "1")
-                except EngineError:
-                    self._send_stream(
-                        "stderr",
-                        "Please quit the front-end (Ctrl-D from the console "
-                        "or qtconsole) to shut the kernel down.\n")
-                    # We don't want to GC the engines as that'll lead to an
-                    # attempt to close an already closed MATLAB during
-                    # `__del__`, which raises an uncatchable exception.  So
-                    # we just keep them around instead.
-                    self._dead_engines.append(self._engine)
-                    self._engine = matlab.engine.start_matlab()
-                else:
-                    raise engine_error
-
+            out = err = None
         elif os.name == "nt":
             out = StringIO()
             err = StringIO()
-
-            try:
-                # call wrapped in try / catch if we're not debugging
-                isdbg = self._engine.is_dbstop_if_error()
-            except (SyntaxError, MatlabExecutionError, KeyboardInterrupt):
-                isdbg = False
-                resources_path = str(Path(sys.modules[__name__.split(".")[0]].__file__).
-                    with_name("res"))
-                self._send_stream("stderr",
-                    "is_dbstop_if_error.m from imatlab resources folder (%s) is not found on path\n" % (resources_path, ))
-
-            try:
-                code_to_run = no_try_code if isdbg else try_code
-                self._execute_with_debug_detection(code_to_run, nargout=0, stdout=out, stderr=err)
-            except (SyntaxError, MatlabExecutionError, KeyboardInterrupt):
-                status = "error"
-            except EngineError as engine_error:
-                # Check whether the engine died.
-                try:
-                    self._call("eval", "1")
-                except EngineError:
-                    self._send_stream(
-                        "stderr",
-                        "Please quit the front-end (Ctrl-D from the console "
-                        "or qtconsole) to shut the kernel down.\n")
-                    # We don't want to GC the engines as that'll lead to an
-                    # attempt to close an already closed MATLAB during
-                    # `__del__`, which raises an uncatchable exception.  So
-                    # we just keep them around instead.
-                    self._dead_engines.append(self._engine)
-                    self._engine = matlab.engine.start_matlab()
-                else:
-                    raise engine_error
-            finally:
-                for name, buf in [("stdout", out), ("stderr", err)]:
-                    buf.seek(0, os.SEEK_END)
-                    size = buf.tell()
-                    if size > 0:
-                        self._send_stream(name, buf.getvalue())
-
-        # elif os.name == "nt":
-        #     self._send_stream("running nt\n")
-        #     try:
-        #         out = StringIO()
-        #         err = StringIO()
-        #         # call wrapped in try / catch if we're not debugging
-        #         isdbg = self._engine.is_dbstop_if_error()
-        #         if isdbg:
-        #             self._call("eval", no_try_code, nargout=0, stdout=out, stderr=err)
-        #         else:
-        #             self._call("eval", try_code, nargout=0, stdout=out, stderr=err)
-        #     except (SyntaxError, MatlabExecutionError, KeyboardInterrupt):
-        #         status = "error"
-        #     finally:
-        #         for name, buf in [("stdout", out), ("stderr", err)]:
-        #             self._send_stream(name, buf.getvalue())
         else:
             raise OSError("Unsupported OS")
 
-        self._debug("About to export figures")
-        self._export_figures()
+        # `imatlab_run_cell` runs the pre- and post-execute hooks, the cell,
+        # and the figure export in a single engine call.
+        result = None
+        live_interval = (0 if self._has_console_frontend
+                         else self._number_setting("IMATLAB_LIVE_FIGURES", 0))
+        watcher = (
+            _live_figures.SnapshotWatcher(
+                tempfile.mkdtemp(prefix="imatlab_live_"))
+            if live_interval > 0 else None)
+        options = {"export": not self._has_console_frontend,
+                   "clearFunctions": cleared_functions,
+                   "rehash": rehash,
+                   "settings": _SETTINGS,
+                   "liveDir": watcher.directory if watcher else "",
+                   "liveInterval": float(live_interval)}
+        try:
+            result = self._execute_with_debug_detection(
+                "imatlab_run_cell", try_code, no_try_code, options,
+                nargout=1, stdout=out, stderr=err,
+                poll=watcher and (lambda: self._show_live_figures(watcher)),
+                poll_interval=live_interval)
+            self._debug("_execute_with_debug_detection returned successfully")
+        except (SyntaxError, MatlabExecutionError, KeyboardInterrupt) as e:
+            self._debug(f"Caught exception (SyntaxError/MatlabExecutionError/KeyboardInterrupt): {e}")
+            status = "error"
+        except EngineError as engine_error:
+            # Check whether the engine died.
+            try:
+                self._call("eval", "1")
+            except EngineError:
+                self._send_stream(
+                    "stderr",
+                    "Please quit the front-end (Ctrl-D from the console "
+                    "or qtconsole) to shut the kernel down.\n")
+                # Dead engines can't just be GC'd (see
+                # `_engine_pool.reap`).
+                self._reap_engine(self._engine)
+                self._replace_engine()
+            else:
+                raise engine_error
+        finally:
+            for name, buf in [("stdout", out), ("stderr", err)]:
+                if buf is not None and buf.getvalue():
+                    self._send_stream(name, buf.getvalue())
+            if watcher:
+                shutil.rmtree(watcher.directory, ignore_errors=True)
+
+        self._debug("About to display figures")
+        # `result` is None if the execution failed or if the engine did
+        # not report completion (e.g. after leaving the debugger).
+        result = result or {}
+        for message in result.get("errors") or []:
+            self._send_stream("stderr", message + "\n")
+        if "settings" in result:
+            self._settings = {**self._environment_settings(),
+                              **(result["settings"] or {})}
+        preview = result.get("preview")
+        if preview:
+            self._send_display_data({"text/html": preview["html"],
+                                     "text/plain": preview["text"]}, {})
+        export_dir = result.get("exportDir")
+        try:
+            self._display_figures(export_dir,
+                                  result.get("exported") or [],
+                                  result.get("figures") or [])
+        finally:
+            if export_dir:
+                shutil.rmtree(export_dir, ignore_errors=True)
+        if result.get("customExporter"):
+            # `imatlab_export_fig` was overridden; use the original protocol.
+            self._export_figures()
         self._debug("Figures exported")
 
+        if not self._run_magics("get", magics):
+            status = "error"
+
+        # Output that the redirection thread has not read yet must still go
+        # through the compactor and the guard of this cell.
+        if self._redirector:
+            self._redirector.drain(timeout=5)
+        self._streams.flush()
+        self._progress.finish()
+        self._output_guard.finish()
+
         # if store_history and code:  # Skip empty lines.
         #     elapsed = time.perf_counter() - start
         #     self._history.append(code, elapsed, status == "ok")
@@ -602,9 +896,134 @@ class MatlabKernel(Kernel):
                     "evalue": "",
                     "traceback": []}
 
+    def get_variable(self, name):
+        """Return a numeric or logical variable of MATLAB's base workspace.
+
+        Full arrays are returned as NumPy arrays, sparse matrices as SciPy
+        CSC matrices, and tables and timetables as pyarrow Tables (see
+        `get_table`).
+        """
+        spec = self._engine.imatlab_get_variable(
+            name, _workspace.mmap_dir(), self._transfer_mmap_bytes(),
+            nargout=1)
+        if spec["class"] in ["table", "timetable"]:
+            return self.get_table(name)
+        return _workspace.to_numpy(spec)
+
+    def put_variable(self, name, value):
+        """Assign a NumPy array (or SciPy sparse matrix) to a variable of
+        MATLAB's base workspace.
+        """
+        spec = _workspace.from_numpy(value, self._transfer_mmap_bytes())
+        try:
+            self._engine.imatlab_put_variable(name, spec, nargout=0)
+        finally:
+            if "file" in spec and os.path.exists(spec["file"]):
+                os.remove(spec["file"])
+
+    def export_table(self, name, path, chunk_rows=None):
+        """Export a table or timetable of MATLAB's base workspace to *path*.
+
+        The format is Parquet or Arrow IPC, depending on whether *path* ends
+        with ``.parquet``, or ``.arrow`` or ``.feather``.  Tables with more
+        than *chunk_rows* rows (by default, IMATLAB_TABLE_CHUNK_ROWS, if set)
+        are written in chunks, to a folder of Parquet files (a Parquet
+        dataset), or to a single IPC file (chunk by chunk).
+        """
+        if chunk_rows is None:
+            chunk_rows = self._number_setting("IMATLAB_TABLE_CHUNK_ROWS", 0)
+        if not path.endswith(_workspace.TABLE_SUFFIXES):
+            raise ValueError("Unsupported table format: {}".format(path))
+        if path.endswith(".parquet"):
+            self._engine.imatlab_export_table(
+                name, path, float(chunk_rows), nargout=0)
+            return
+        parquet = _workspace.temp_path(".parquet")
+        try:
+            self._engine.imatlab_export_table(
+                name, parquet, float(chunk_rows), nargout=0)
+            _workspace.parquet_to_ipc(parquet, path)
+        finally:
+            _workspace.remove(parquet)
+
+    def get_table(self, name):
+        """Return a table or timetable of MATLAB's base workspace as a pyarrow
+        Table, backed by a memory-mapped Arrow IPC file.
+        """
+        path = _workspace.temp_path(".arrow")
+        try:
+            self.export_table(name, path)
+            return _workspace.read_table(path, remove_file=True)
+        finally:
+            _workspace.remove(path)
+
+    def iter_table(self, name, chunk_rows=100000):
+        """Iterate over a table or timetable of MATLAB's base workspace, as
+        pyarrow RecordBatches.
+
+        The table is exported in chunks of *chunk_rows* rows, so that neither
+        MATLAB nor Python holds a second copy of it in memory.
+        """
+        path = _workspace.temp_path(".parquet")
+        try:
+            self.export_table(name, path, chunk_rows)
+            yield from _workspace.iter_batches(path, remove_parts=True)
+        finally:
+            _workspace.remove(path)
+
+    def _transfer_mmap_bytes(self):
+        return self._number_setting("IMATLAB_TRANSFER_MMAP_BYTES", 64e6)
+
+    def _run_magics(self, command, magics):
+        """Run the `%get` or `%put` magics of a cell; return whether they all
+        succeeded.
+
+        `%put name [path.npy]` assigns ``user_ns[name]`` (or the array saved
+        in *path*) to the MATLAB variable *name*; `%get name [path.npy]` does
+        the converse.  `%get name path.{parquet,arrow,feather}` exports a
+        table.
+        """
+        for magic, name, path in magics:
+            if magic != command:
+                continue
+            try:
+                if command == "put":
+                    if path and path.endswith(_workspace.TABLE_SUFFIXES):
+                        raise ValueError(
+                            "Tables can only be exported, with %get.")
+                    elif path:
+                        value = _workspace.load(path)
+                    elif name in self.user_ns:
+                        value = self.user_ns[name]
+                    else:
+                        raise KeyError(
+                            "No array named {!r} to put.".format(name))
+                    self.put_variable(name, value)
+                elif path and path.endswith(_workspace.TABLE_SUFFIXES):
+                    self.export_table(name, path)
+                    value = self.user_ns[name] = _workspace.read_table(path)
+                else:
+                    value = self.user_ns[name] = self.get_variable(name)
+                    if path:
+                        _workspace.save(path, value)
+            except (ImportError, KeyError, OSError, TypeError, ValueError,
+                    MatlabExecutionError) as exc:
+                self._send_stream(
+                    "stderr", "%{} {}: {}\n".format(command, name, exc))
+                return False
+            self._send_stream("stdout", "%{} {}: {}\n".format(
+                command, name, _workspace.describe(value)))
+        return True
+
     def _export_figures(self):
+        """Export figures with a custom `imatlab_export_fig`.
+
+        Such exporters are called with no arguments while the current
+        directory is a temporary folder, and return the exported filenames.
+        """
+        # `imatlab_run_cell` only reports a custom exporter if figures were
+        # created.
         if (self._has_console_frontend
-                or not len(self._call("get", 0., "children"))
                 or not self._call("which", "imatlab_export_fig")):
             return
         with TemporaryDirectory() as tmpdir:
@@ -614,44 +1033,253 @@ class MatlabKernel(Kernel):
                 exported = self._engine.imatlab_export_fig()
             finally:
                 self._call("cd", cwd)
-            for path in map(Path(tmpdir).joinpath, exported):
-                if path.suffix.lower() == ".html":
-                    # https://github.com/jupyter/notebook/issues/2287
-                    # Delay import, as this is not a dependency otherwise.
-                    import notebook
-                    if notebook.__version__ == "5.0.0":
-                        self._send_stream(
-                            "stderr",
-                            "Plotly output is not supported with "
-                            "notebook==5.0.0.  Please update to a newer "
-                            "version.")
-                    elif not plotly:
-                        self._send_stream(
-                            "stderr",
-                            "Failed to import both matlab.engine and plotly "
-                            "in the same process; plotly output is "
-                            "unavailable.")
-                    else:
-                        self._plotly_init_notebook_mode()
-                        self._send_display_data(
-                            {"text/html": path.read_text()}, {})
-                elif path.suffix.lower() == ".png":
-                    self._send_display_data(
-                        {"image/png":
-                         base64.b64encode(path.read_bytes()).decode("ascii")},
-                        {})
-                elif path.suffix.lower() in [".jpeg", ".jpg"]:
-                    self._send_display_data(
-                        {"image/jpeg":
-                         base64.b64encode(path.read_bytes()).decode("ascii")},
-                        {})
-                elif path.suffix.lower() == ".svg":
-                    self._send_display_data(
-                        # Probably should read the encoding from the file.
-                        {"image/svg+xml": path.read_text(encoding="ascii")},
-                        {})
+            self._display_figures(tmpdir, exported)
+
+    def _display_figures(self, directory, exported, numbers=()):
+        """Display exported figures, exporting the remaining ones in turn.
+
+        *exported* holds the exports of the first figures in *numbers* (if
+        known); the others are exported one at a time.  Each figure is
+        encoded in the thread pool, while MATLAB renders the next one, and
+        sent as soon as it is encoded (in order).
+        """
+        options = self._figure_options()
+        numbers = list(numbers)
+        # Above the threshold, figures are collected into a gallery.
+        threshold = self._number_setting("IMATLAB_FIGURE_GALLERY", 0)
+        gallery = ([] if threshold and len(numbers) > threshold
+                   and _images.can_thumbnail() else None)
+        tasks = []
+        sent = threading.Event()
+        sent.set()
+        def submit(entry, number):
+            nonlocal sent
+            previous, sent = sent, threading.Event()
+            tasks.append(self._encoder.submit(
+                self._encode_and_send,
+                directory, entry, options, number, gallery, previous, sent))
+        for k, entry in enumerate(exported):
+            submit(entry, numbers[k] if k < len(numbers) else None)
+        for number in numbers[len(exported):]:
+            try:
+                submit(self._engine.imatlab_export_figure(
+                    number, directory, nargout=1), number)
+            except (MatlabExecutionError, EngineError) as e:
+                self._send_stream(
+                    "stderr",
+                    "Failed to export figure {}: {}\n".format(int(number), e))
+        for task in tasks:
+            try:
+                task.result()
+            except Exception as e:
+                self._send_stream(
+                    "stderr", "Failed to display a figure: {}\n".format(e))
+        if gallery:
+            self._send_gallery(gallery)
+
+    def _figure_options(self):
+        return _images.Options(
+            format=self._setting("IMATLAB_FIGURE_FORMAT", "png").lower(),
+            colors=self._number_setting("IMATLAB_FIGURE_COLORS", 0),
+            max_pixels=self._number_setting("IMATLAB_FIGURE_MAX_PIXELS", 0),
+            max_bytes=self._number_setting("IMATLAB_FIGURE_MAX_BYTES", 0),
+            optimize=self._setting("IMATLAB_FIGURE_OPTIMIZE", "1") != "0")
+
+    def _show_live_figures(self, watcher):
+        """Display (or update) the figure snapshots taken while a cell runs.
+
+        They share their display with the figure's final export, which thus
+        replaces the last snapshot.
+        """
+        options = self._figure_options()
+        for number, png in watcher.poll():
+            try:
+                data, metadata = self._encode_image(
+                    *_images.process("image/png", png, options))
+            except Exception as e:
+                self._debug(f"Failed to encode a figure snapshot: {e}")
+                continue
+            action, display_id = self._figure_displays.publish(number, data)
+            if action:
+                self._send_display_data(
+                    data, metadata, display_id=display_id,
+                    update=action == "update")
+
+    def _encode_and_send(self, directory, entry, options, number, gallery,
+                         previous, sent):
+        try:
+            data, metadata = self._encode_exported(directory, entry, options)
+            thumbnail = (self._make_thumbnail(data)
+                         if gallery is not None and data else None)
+            previous.wait()
+            if not data:
+                return
+            if thumbnail:
+                key = uuid.uuid4().hex
+                self._gallery.put(key, thumbnail[0])
+                gallery.append((key, number, thumbnail[1]))
+                return
+            # The final export of a figure replaces its live snapshot (or is
+            # not resent at all if identical to it).
+            action, display_id = (
+                self._figure_displays.publish(number, data)
+                if number is not None and number in self._figure_displays
+                else ("display", None))
+            if action == "display" and "text/html" in data:
+                self._plotly_init_notebook_mode()
+            if action:
+                self._send_display_data(
+                    data, metadata, display_id=display_id,
+                    update=action == "update")
+        finally:
+            sent.set()
+
+    @staticmethod
+    def _make_thumbnail(data):
+        # Return ((mimetype, full data), thumbnail data), or None for figures
+        # that are not raster images.
+        for mimetype, value in data.items():
+            if mimetype.startswith("image/") and mimetype != "image/svg+xml":
+                return ((mimetype, value),
+                        base64.b64encode(_images.thumbnail(
+                            base64.b64decode(value))).decode("ascii"))
+        return None
+
+    def _send_gallery(self, entries):
+        gallery_id = "imatlab-gallery-{}".format(uuid.uuid4())
+        images = "".join(
+            '<img src="data:image/png;base64,{thumbnail}" data-key="{key}" '
+            'title="Figure {number}" '
+            'style="margin: 2px; cursor: pointer; vertical-align: top">'
+            .format(thumbnail=thumbnail, key=key, number=int(number))
+            for key, number, thumbnail in entries)
+        self._send_display_data(
+            {"text/html": _GALLERY_TEMPLATE.format(
+                id=gallery_id, images=images),
+             "text/plain": "<Gallery of {} figures>".format(len(entries))},
+            {})
+
+    def _open_gallery_comm(self, comm, msg):
+        # Each message requests the full-size figure for a thumbnail's key.
+        @comm.on_msg
+        def on_msg(msg):
+            key = msg["content"]["data"].get("key")
+            entry = self._gallery.get(key)
+            if entry is None:
+                comm.send({"key": key,
+                           "error": "This figure is no longer available."})
+            else:
+                mimetype, data = entry
+                comm.send({"key": key, "mimetype": mimetype, "data": data})
+
+    def _open_inspector_comm(self, comm, msg):
+        # Each message requests either the list of variables, or a page of
+        # the preview of one of them; the reply echoes the request's "id".
+        @comm.on_msg
+        def on_msg(msg):
+            request = msg["content"]["data"]
+            try:
+                if request.get("request") == "preview":
+                    reply = self.preview_variable(
+                        request["name"],
+                        *[int(request.get(key, 1))
+                          for key in ["row", "col", "page"]],
+                        *[int(request.get(key, 100))
+                          for key in ["rows", "cols"]])
+                else:
+                    reply = {"variables": self.list_variables()}
+            except (KeyError, TypeError, ValueError,
+                    MatlabExecutionError) as exc:
+                reply = {"error": str(exc)}
+            reply["id"] = request.get("id")
+            comm.send(reply)
+
+    def list_variables(self):
+        """Return the name, size, bytes, class, complex, sparse and global
+        fields of `whos` for each variable of MATLAB's base workspace.
+
+        The list is computed at most once per execution count.
+        """
+        count, variables = self._inspector_cache
+        if count != self.execution_count:
+            variables = json.loads(self._engine.imatlab_whos(
+                nargout=1, stdout=StringIO(), stderr=StringIO()))
+            self._inspector_cache = self.execution_count, variables
+        return variables
+
+    def preview_variable(self, name, row=1, col=1, page=1, rows=100,
+                         cols=100):
+        """Return a window of at most *rows* x *cols* (and 100 x 100) elements
+        of a variable of MATLAB's base workspace, rendered as text.
+
+        See `imatlab_preview_variable.m` for the format; only the window is
+        transferred from MATLAB.
+        """
+        return json.loads(self._engine.imatlab_preview_variable(
+            name, *map(float, [row, col, page, rows, cols]),
+            nargout=1, stdout=StringIO(), stderr=StringIO()))
+
+    def _encode_exported(self, directory, entry, options):
+        # Return the display data and metadata for an exported figure, or
+        # (None, None).
+        if isinstance(entry, dict) and entry.get("format") == "plotly":
+            return self._plotly_bundle(json.loads(entry["json"])), {}
+        if isinstance(entry, dict):
+            # Pixels captured by a `memory-*` exporter.
+            return self._encode_image(*_images.encode(entry, options))
+        path = Path(directory, entry)
+        if path.suffix.lower() == ".html":
+            # https://github.com/jupyter/notebook/issues/2287
+            # Delay import, as this is not a dependency otherwise.
+            import notebook
+            if notebook.__version__ == "5.0.0":
+                self._send_stream(
+                    "stderr",
+                    "Plotly output is not supported with "
+                    "notebook==5.0.0.  Please update to a newer "
+                    "version.")
+            elif not plotly:
+                self._send_stream(
+                    "stderr",
+                    "Failed to import both matlab.engine and plotly "
+                    "in the same process; plotly output is "
+                    "unavailable.")
+            else:
+                return {"text/html": path.read_text()}, {}
+        elif path.suffix.lower() == ".png":
+            return self._encode_image(*_images.process(
+                "image/png", path.read_bytes(), options))
+        elif path.suffix.lower() in [".jpeg", ".jpg"]:
+            return self._encode_image(*_images.process(
+                "image/jpeg", path.read_bytes(), options))
+        elif path.suffix.lower() == ".svg":
+            # Probably should read the encoding from the file.
+            return {"image/svg+xml": _images.minify_svg(
+                path.read_text(encoding="ascii"))}, {}
+        return None, None
+
+    @staticmethod
+    def _encode_image(mimetype, data, metadata):
+        return ({mimetype: base64.b64encode(data).decode("ascii")},
+                {mimetype: metadata} if metadata else {})
+
+    @staticmethod
+    def _plotly_bundle(figure):
+        # Frontends that render plotly's mimetype natively only need the
+        # figure's JSON; the HTML fallback relies on plotly.js having been
+        # loaded by `_plotly_init_notebook_mode`.
+        bundle = {"application/vnd.plotly.v1+json": figure}
+        if plotly:
+            bundle["text/html"] = plotly.offline.plot(
+                figure, output_type="div", include_plotlyjs=False,
+                validate=False)
+        return bundle
 
     def _plotly_init_notebook_mode(self):
+        # Only needed once per session, as it loads plotly.js into the page.
+        if self._plotly_initialized:
+            return
+        self._plotly_initialized = True
         # Hack into display routine.  Also pretend that the InteractiveShell is
         # initialized as display() is otherwise turned into a no-op.
         with patch.multiple(IPython.core.display,
@@ -753,7 +1381,13 @@ class MatlabKernel(Kernel):
 
         self._call("exit", nargout=0)
         if restart:
-            self._engine = matlab.engine.start_matlab()
             # Recreate temp directory after restart
             self._temp_func_dir = tempfile.mkdtemp(prefix="imatlab_funcs_")
-            self._engine.addpath(self._temp_func_dir, "-begin", nargout=0)
+            self._function_store = _function_store.FunctionStore(
+                self._temp_func_dir)
+            self._replace_engine()
+        else:
+            # The encoder threads are only reused across restarts.
+            self._encoder.shutdown(wait=False)
+            if self._engine_pool:
+                self._engine_pool.close()
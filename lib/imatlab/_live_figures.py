@@ -0,0 +1,42 @@
+"""Pick up the figure snapshots written while a cell runs.
+
+`imatlab_live_figures.m` periodically writes each figure to
+``<number>.png`` in a folder (via a temporary file and a rename, so that
+files are always complete), which is polled from the kernel's wait loop.
+"""
+
+import os
+
+
+class SnapshotWatcher:
+    """Report the snapshots in *directory* that changed since the last poll.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._seen = {}  # Figure number -> (mtime, size).
+
+    def poll(self):
+        """Return a list of ``(figure number, png data)`` of new snapshots.
+        """
+        changed = []
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return changed
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+            if ext != ".png" or not stem.isdigit():
+                continue  # Including snapshots being written.
+            try:
+                stat = entry.stat()
+                key = (stat.st_mtime_ns, stat.st_size)
+                if self._seen.get(int(stem)) == key:
+                    continue
+                with open(entry.path, "rb") as file:
+                    data = file.read()
+            except OSError:
+                continue  # Replaced in the meantime; picked up next time.
+            self._seen[int(stem)] = key
+            changed.append((int(stem), data))
+        return sorted(changed, key=lambda item: item[0])
@@ -7,34 +7,162 @@ support Windows.
 from contextlib import contextmanager
 import os
 from selectors import DefaultSelector, EVENT_READ
-from threading import Thread
 import socket
+import threading
 
 
-@contextmanager
-def redirect(fd, callback):
-    save_fd = os.dup(fd)
+class Redirector:
+    """Redirect file descriptors to callbacks, served by a single thread.
+
+    *callbacks* maps each fd to redirect to a callable, which is called (from
+    the reader thread) with a memoryview of the data read.  The view is only
+    valid during the call, as the underlying buffer is reused for later
+    reads; callbacks must copy (or decode) the data before returning.
+
+    Reads start at *min_read* bytes, and the read size is doubled (up to
+    *max_read*) whenever a read fills it, so that heavy output is consumed
+    in few large reads, and halved again when reads become small.
+    """
+
+    def __init__(self, callbacks, min_read=4096, max_read=1 << 20):
+        self._min_read = min_read
+        self._max_read = max_read
+        self._buffer = bytearray(max_read)
+        self._view = memoryview(self._buffer)
+        self._selector = DefaultSelector()
+        self._saved = {}  # Redirected fd -> duplicate of the original fd.
+        self._sockets = []
+        self._closed = False
+        self._drain_lock = threading.Lock()
+        self._drain_events = []  # Set once the sockets have been drained.
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, EVENT_READ)
+        try:
+            for fd, callback in callbacks.items():
+                self._add(fd, callback)
+        except BaseException:
+            self._restore()
+            self._close_sockets()
+            raise
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _add(self, fd, callback):
+        s_in, s_out = socket.socketpair()
+        self._sockets.append(s_out)
+        try:
+            self._saved[fd] = os.dup(fd)
+            os.dup2(s_in.fileno(), fd)
+        finally:
+            # fd now refers to the socket on its own.
+            s_in.close()
+        s_out.setblocking(False)
+        self._selector.register(s_out, EVENT_READ, [callback, self._min_read])
+
+    def drain(self, timeout=None):
+        """Wait until the data written to the fds so far has been forwarded.
 
-    s_in, s_out = socket.socketpair()
-    os.dup2(s_in.fileno(), fd)
-    os.close(s_in.fileno())
-    s_out.setblocking(False)
+        Returns whether this happened before *timeout*.
+        """
+        if self._closed:
+            return True
+        event = threading.Event()
+        with self._drain_lock:
+            self._drain_events.append(event)
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:  # Closed in the meantime, and thus drained.
+            return True
+        return event.wait(timeout)
 
-    sel = DefaultSelector()
-    sel.register(s_out, EVENT_READ)
+    def close(self):
+        """Restore the original fds, then forward the remaining data.
 
-    def target():
-        while running:
-            _, = sel.select()  # There's only one event.
-            callback(s_out.recv(4096))
+        Returns once the reader thread has exited.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        # Once the fds are restored, nothing is written to the sockets
+        # anymore, so draining them afterwards loses no output.
+        self._restore()
+        self._wake_w.send(b"\0")
+        self._thread.join()
+        self._close_sockets()
 
-    running = True
-    thread = Thread(target=target, daemon=True)
-    thread.start()
+    def _restore(self):
+        for fd, save_fd in self._saved.items():
+            os.dup2(save_fd, fd)
+            os.close(save_fd)
+        self._saved = {}
 
+    def _close_sockets(self):
+        self._selector.close()
+        for sock in [self._wake_r, self._wake_w, *self._sockets]:
+            sock.close()
+
+    def _read(self, key):
+        # Read once into the shared buffer; return whether data was read.
+        state = key.data
+        callback, size = state
+        try:
+            n = key.fileobj.recv_into(self._view[:size])
+        except (BlockingIOError, InterruptedError):
+            return False
+        if not n:  # All writers are gone.
+            self._selector.unregister(key.fileobj)
+            return False
+        if n == size:
+            state[1] = min(size * 2, self._max_read)
+        elif n < size // 4:
+            state[1] = max(size // 2, self._min_read)
+        try:
+            callback(self._view[:n])
+        except Exception:
+            pass  # Keep reading, lest the writers block on a full socket.
+        return True
+
+    def _drain(self):
+        # Forward everything that is readable right now.  Data written before
+        # this call is already in the sockets, so none of it is left behind.
+        for key in list(self._selector.get_map().values()):
+            if key.fileobj is not self._wake_r:
+                while self._read(key):
+                    pass
+
+    def _run(self):
+        while True:
+            woken = False
+            for key, _ in self._selector.select():
+                if key.fileobj is self._wake_r:
+                    woken = True
+                    continue
+                self._read(key)
+            if self._closed:
+                break
+            if woken:
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except (BlockingIOError, InterruptedError):
+                    pass
+                with self._drain_lock:
+                    events, self._drain_events = self._drain_events, []
+                self._drain()
+                for event in events:
+                    event.set()
+        self._drain()
+        with self._drain_lock:
+            events, self._drain_events = self._drain_events, []
+        for event in events:
+            event.set()
+
+
+@contextmanager
+def redirect(fd, callback):
+    redirector = Redirector({fd: callback})
     try:
         yield
     finally:
-        running = False
-        os.dup2(save_fd, fd)
-        os.close(save_fd)
+        redirector.close()
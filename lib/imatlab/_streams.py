@@ -0,0 +1,401 @@
+"""Batching of stream output sent to the frontend.
+"""
+
+import codecs
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+
+class StreamBatcher:
+    """Coalesce stream output and send it, in order, from a single thread.
+
+    Raw output (e.g. from the redirected file descriptors) is decoded
+    incrementally, so that multibyte characters split across reads are not
+    mangled.  Consecutive writes to the same stream are merged, and sent once
+    *interval* seconds have elapsed since the first pending write, once
+    *max_bytes* are pending, or upon `flush`.
+
+    *send* is called with ``(name, text)`` from the sender thread only.
+    """
+
+    def __init__(self, send, interval=0.05, max_bytes=65536, log=None):
+        self._send = send
+        self._interval = interval
+        self._max_bytes = max_bytes
+        self._log = log or (lambda message: None)
+        self._decoders = {}
+        self._pending = []  # List of [name, text].
+        self._pending_size = 0
+        self._first_pending = None
+        # Writes are numbered, so that `flush` can wait for a given write to
+        # have been sent.
+        self._written = self._sent = self._flush_target = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, name, data, encoding="utf-8"):
+        """Queue raw *data* (bytes-like) for stream *name*.
+        """
+        decoder = self._decoders.get(name)
+        if decoder is None:
+            decoder = self._decoders[name] = codecs.getincrementaldecoder(
+                encoding)(errors="replace")
+        self.write_text(name, decoder.decode(data))
+
+    def write_text(self, name, text):
+        """Queue *text* for stream *name*.
+        """
+        if not text:
+            return
+        with self._cond:
+            if self._pending and self._pending[-1][0] == name:
+                self._pending[-1][1] += text
+            else:
+                self._pending.append([name, text])
+            if self._first_pending is None:
+                self._first_pending = time.monotonic()
+            self._pending_size += len(text)
+            self._written += 1
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until everything written so far has been sent.
+        """
+        with self._cond:
+            self._flush_target = max(self._flush_target, self._written)
+            self._cond.notify_all()
+            return self._cond.wait_for(
+                lambda: self._sent >= self._flush_target or self._closed,
+                timeout)
+
+    def close(self):
+        """Send pending output and stop the sender thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    return
+                deadline = self._first_pending + self._interval
+                while (self._pending_size < self._max_bytes
+                       and self._sent >= self._flush_target
+                       and not self._closed):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending, []
+                self._pending_size = 0
+                self._first_pending = None
+                written = self._written
+            for name, text in batch:
+                try:
+                    self._send(name, text)
+                except Exception as e:
+                    self._log("Failed to send stream output: {}".format(e))
+            with self._cond:
+                self._sent = written
+                self._cond.notify_all()
+
+
+class OutputGuard:
+    """Cap the output of a cell, spilling the excess to a file.
+
+    Output is passed through to *send* until *max_bytes* (UTF-8 encoded) or
+    *max_lines* are reached within a cell.  The rest is then written (along
+    with the output already sent) to a file in *spill_dir*, and only the last
+    *tail_lines* lines are sent (each part to the stream it was written to)
+    when the cell finishes, together with the path and size of the spill
+    file.
+    """
+
+    def __init__(self, send, tail_lines=10, tail_bytes=8192):
+        self._send = send
+        self._tail_lines = tail_lines
+        self._tail_bytes = tail_bytes
+        self._lock = threading.Lock()
+        self._max_bytes = self._max_lines = None
+        self._reset()
+
+    def _reset(self):
+        self._bytes = self._lines = 0
+        self._head = []
+        self._spill = self._spill_path = self._spill_error = None
+        self._spilled_bytes = self._spilled_lines = 0
+        self._tail = []  # List of [name, text], of at most tail_bytes chars.
+        self._tail_size = 0
+
+    def start(self, max_bytes, max_lines, spill_dir, name):
+        """Start guarding the output of a cell.
+
+        A falsy limit is not enforced; *name* is used for the spill file.
+        """
+        with self._lock:
+            self._reset()
+            self._max_bytes = int(max_bytes) if max_bytes else None
+            self._max_lines = int(max_lines) if max_lines else None
+            self._spill_dir = spill_dir
+            self._name = name
+
+    def send(self, name, text):
+        with self._lock:
+            if self._max_bytes is None and self._max_lines is None:
+                self._send(name, text)
+                return
+            if self._spill is not None:
+                self._write_spill(name, text)
+                return
+            data = text.encode("utf-8")
+            lines = text.count("\n")
+            if ((self._max_bytes is None
+                 or self._bytes + len(data) <= self._max_bytes)
+                    and (self._max_lines is None
+                         or self._lines + lines <= self._max_lines)):
+                self._bytes += len(data)
+                self._lines += lines
+                self._head.append((name, text))
+                self._send(name, text)
+                return
+            # Send what still fits, then spill.
+            cut = len(text)
+            if (self._max_lines is not None
+                    and self._lines + lines > self._max_lines):
+                pos = -1
+                for _ in range(max(self._max_lines - self._lines, 0)):
+                    pos = text.index("\n", pos + 1)
+                cut = pos + 1
+            if self._max_bytes is not None:
+                cut = min(cut, len(
+                    data[:max(self._max_bytes - self._bytes, 0)]
+                    .decode("utf-8", "ignore")))
+            if cut:
+                self._head.append((name, text[:cut]))
+                self._send(name, text[:cut])
+            try:
+                self._open_spill()
+            except OSError as e:
+                self._send("stderr", "\n[Output limit reached; failed to "
+                           "create a file for the rest: {}]\n".format(e))
+                self._spill_error = e
+                self._spill = open(os.devnull, "w", encoding="utf-8")
+            else:
+                self._send("stderr", "\n[Output limit reached; the rest is "
+                           "written to {}]\n".format(self._spill_path))
+            self._write_spill(name, text[cut:])
+
+    def _open_spill(self):
+        os.makedirs(self._spill_dir, exist_ok=True)
+        fd, self._spill_path = tempfile.mkstemp(
+            dir=self._spill_dir, prefix="{}-".format(self._name),
+            suffix=".txt")
+        self._spill = open(fd, "w", encoding="utf-8")
+        for name, text in self._head:
+            self._spill.write(text)
+        self._head = []
+
+    def _write_spill(self, name, text):
+        self._spill.write(text)
+        self._spilled_bytes += len(text.encode("utf-8"))
+        self._spilled_lines += text.count("\n")
+        if not text:
+            return
+        if self._tail and self._tail[-1][0] == name:
+            self._tail[-1][1] += text
+        else:
+            self._tail.append([name, text])
+        self._tail_size += len(text)
+        while self._tail_size > self._tail_bytes:
+            excess = self._tail_size - self._tail_bytes
+            first = self._tail[0]
+            if len(first[1]) <= excess:
+                self._tail.pop(0)
+                self._tail_size -= len(first[1])
+            else:
+                first[1] = first[1][excess:]
+                self._tail_size -= excess
+
+    def finish(self):
+        """Stop guarding the current cell; send the tail of spilled output.
+        """
+        with self._lock:
+            if self._spill is not None:
+                self._spill.close()
+                # Only keep the last lines, starting at a line boundary.
+                text = "".join(text for _, text in self._tail)
+                lines = text.split("\n")
+                if len(lines) > self._tail_lines + 1:
+                    lines = lines[1:]
+                tail = "\n".join(lines[-self._tail_lines - 1:])
+                omitted = self._spilled_bytes - len(tail.encode("utf-8"))
+                if omitted:
+                    self._send("stderr", "\n[... {} more bytes ({} lines) "
+                               "omitted ...]\n".format(
+                                   omitted,
+                                   self._spilled_lines - tail.count("\n")))
+                # Each part of the tail is sent to the stream it came from.
+                skip = len(text) - len(tail)
+                for name, part in self._tail:
+                    if len(part) > skip:
+                        self._send(name, part[skip:])
+                    skip = max(skip - len(part), 0)
+                if self._spill_path is None:
+                    self._send("stderr", "\n[The rest of the output was "
+                               "discarded, as no file could be created for "
+                               "it: {}]\n".format(self._spill_error))
+                else:
+                    self._send("stderr", "\n[Full output ({} bytes) written "
+                               "to {}]\n".format(
+                                   os.path.getsize(self._spill_path),
+                                   self._spill_path))
+            self._max_bytes = self._max_lines = None
+            self._reset()
+
+
+class ProgressCompactor:
+    """Render carriage returns and backspaces before sending stream output.
+
+    Lines that overwrite themselves (``fprintf('\\r%d%%', k)``) are not sent
+    as stream output, which would record every update in the notebook, but as
+    a display that is updated in place with the line's current state, at most
+    once per *interval* seconds (and once more when the line is completed).
+    Updates arriving faster are coalesced, and the latest one is sent once
+    the interval has elapsed, even if no further output arrives.
+
+    *send* is called with ``(name, text)`` for plain stream output and
+    *display* with ``(text, display_id, update)`` for overwritten lines.
+    *clock* and *timer* (with the signatures of `time.monotonic` and
+    `threading.Timer`) can be replaced, e.g. for testing.
+    """
+
+    def __init__(self, send, display, interval=0.25,
+                 clock=time.monotonic, timer=threading.Timer):
+        self._send = send
+        self._display = display
+        self._interval = interval
+        self._clock = clock
+        self._make_timer = timer
+        self._lock = threading.Lock()
+        self._lines = {}  # Stream name -> _ProgressLine.
+        self._timer = None  # Sends throttled updates.
+
+    def configure(self, interval):
+        """Set the update interval; a falsy value disables compaction.
+        """
+        with self._lock:
+            self._interval = interval
+
+    def send(self, name, text):
+        with self._lock:
+            line = self._lines.get(name)
+            if line is None and (not self._interval
+                                 or ("\r" not in text and "\b" not in text)):
+                self._send(name, text)
+                return
+            *complete, partial = text.replace("\r\n", "\n").split("\n")
+            for segment in complete:
+                if line is None and "\r" not in segment and "\b" not in segment:
+                    self._send(name, segment + "\n")
+                    continue
+                if line is None:
+                    line = _ProgressLine()
+                line.write(segment)
+                self._show(line, final=True)
+                line = None
+            if partial:
+                if line is None and "\r" not in partial and "\b" not in partial:
+                    self._send(name, partial)
+                else:
+                    if line is None:
+                        line = _ProgressLine()
+                    line.write(partial)
+                    self._show(line, final=False)
+            if line is None:
+                self._lines.pop(name, None)
+            else:
+                self._lines[name] = line
+
+    def finish(self):
+        """Send the final state of lines that are still being overwritten.
+        """
+        with self._lock:
+            self._cancel_timer()
+            for line in self._lines.values():
+                self._show(line, final=True)
+            self._lines.clear()
+
+    def _show(self, line, final):
+        now = self._clock()
+        if line.display_id is None:
+            line.display_id = "imatlab-progress-{}".format(uuid.uuid4())
+            self._display(line.text(), line.display_id, False)
+        elif final or now - line.last_shown >= self._interval:
+            text = line.text()
+            if text != line.shown:
+                self._display(text, line.display_id, True)
+        else:
+            # Send the latest state once the interval has elapsed.
+            if self._timer is None:
+                def on_timer():
+                    self._on_timer(timer)
+                self._timer = timer = self._make_timer(
+                    line.last_shown + self._interval - now, on_timer)
+                timer.daemon = True
+                timer.start()
+            return
+        line.shown = line.text()
+        line.last_shown = now
+
+    def _on_timer(self, timer):
+        with self._lock:
+            if self._timer is not timer:
+                return  # Cancelled (e.g. by `finish`) in the meantime.
+            self._timer = None
+            for line in self._lines.values():
+                # Bypass the throttling, as the timer may fire marginally
+                # early.
+                self._show(line, final=True)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class _ProgressLine:
+    def __init__(self):
+        self.chars = []
+        self.cursor = 0
+        self.display_id = None
+        self.shown = None
+        self.last_shown = 0
+
+    def write(self, text):
+        if "\b" in text:
+            for c in text:
+                if c == "\r":
+                    self.cursor = 0
+                elif c == "\b":
+                    self.cursor = max(self.cursor - 1, 0)
+                else:
+                    self.chars[self.cursor:self.cursor + 1] = c
+                    self.cursor += 1
+            return
+        for i, piece in enumerate(text.split("\r")):
+            if i:
+                self.cursor = 0
+            self.chars[self.cursor:self.cursor + len(piece)] = piece
+            self.cursor += len(piece)
+
+    def text(self):
+        return "".join(self.chars)
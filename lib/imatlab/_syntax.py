@@ -0,0 +1,408 @@
+"""Lightweight MATLAB tokenizer.
+
+This only understands as much of the MATLAB syntax as needed to find the
+block structure of a cell (strings, comments, block comments, continuations,
+command syntax, and `end` used for indexing), so that common operations do
+not require a round trip to the engine.  When in doubt, functions return None
+and callers should fall back to MATLAB's own parser (`mtree`).
+"""
+
+import re
+
+
+# Keywords that open a block closed by `end`.
+_BLOCK_KEYWORDS = {
+    "if", "for", "parfor", "while", "switch", "try", "spmd", "function"}
+_KEYWORDS = _BLOCK_KEYWORDS | {
+    "end", "else", "elseif", "case", "otherwise", "catch", "break",
+    "continue", "return", "global", "persistent", "classdef"}
+_NAME_RE = re.compile(r"[A-Za-z]\w*")
+_NUMBER_RE = re.compile(
+    r"(?:\d+\.?\d*|\.\d+)(?:[eEdD][+-]?\d+)?[ij]?")
+_BLOCK_COMMENT_START_RE = re.compile(r"[ \t]*%\{[ \t\r]*(?:\n|\Z)")
+_BLOCK_COMMENT_LINE_RE = re.compile(r"[ \t]*%([{}])[ \t\r]*\Z")
+# Arguments blocks: `arguments`, `arguments (Repeating)`, etc.
+_ARGUMENTS_RE = re.compile(
+    r"arguments[ \t]*(?:\([ \t]*(?:Repeating|Input|Output)[ \t]*\))?"
+    r"[ \t]*(?:[;,%\r\n]|\Z)")
+
+
+class _Unsure(Exception):
+    pass
+
+
+class Token:
+    __slots__ = ["kind", "text", "line", "start", "depth", "statement_start"]
+
+    def __init__(self, kind, text, line, start, depth, statement_start):
+        self.kind = kind  # "name", "number", "string", "command", "op", "eos".
+        self.text = text
+        self.line = line  # 0-based line number.
+        self.start = start  # Offset in the source.
+        self.depth = depth  # Bracket nesting depth.
+        self.statement_start = statement_start
+
+    def __repr__(self):
+        return "Token({!r}, {!r}, line={})".format(
+            self.kind, self.text, self.line)
+
+
+def tokenize(code):
+    """Tokenize MATLAB code, dropping comments and continuations.
+
+    Statement separators (newlines outside of brackets, commas and semicolons
+    outside of brackets) are reported as "eos" tokens.  Raises `_Unsure` on
+    constructs that this tokenizer does not handle.
+    """
+    tokens = []
+    brackets = []
+    i = 0
+    n = len(code)
+    line = 0
+    line_start = True  # Only whitespace so far on this line.
+    statement_start = True
+    spaced = False  # Whitespace precedes the current position.
+
+    def add(kind, text, start):
+        nonlocal statement_start, line_start
+        tokens.append(Token(kind, text, line, start, len(brackets),
+                            statement_start and kind != "eos"))
+        statement_start = kind == "eos"
+        line_start = False
+
+    def prev():
+        return tokens[-1] if tokens else None
+
+    while i < n:
+        c = code[i]
+        if c == "\n":
+            if brackets and brackets[-1] == "(":
+                raise _Unsure("Newline in parentheses")
+            if not brackets:
+                add("eos", c, i)
+            line += 1
+            i += 1
+            line_start = True
+            spaced = True
+            continue
+        if c in " \t\r":
+            i += 1
+            spaced = True
+            continue
+        if c == "%":
+            if line_start and _BLOCK_COMMENT_START_RE.match(code, i):
+                i, line = _skip_block_comment(code, i, line)
+            else:
+                i = _find_eol(code, i)
+            spaced = True
+            continue
+        if code.startswith("...", i):
+            # Continuation: the rest of the line is a comment.
+            i = _find_eol(code, i) + 1
+            line += 1
+            spaced = True
+            continue
+        if c == "!" and line_start:
+            raise _Unsure("Shell escape")
+        was_spaced, spaced = spaced, False
+        p = prev()
+        if c.isalpha():
+            m = _NAME_RE.match(code, i)
+            add("name", m.group(), i)
+            i = m.end()
+            if (tokens[-1].statement_start and not brackets
+                    and m.group() not in _KEYWORDS
+                    and _is_command_syntax(code, i)):
+                j = _skip_command(code, i)
+                add("command", code[i:j].strip(), i)
+                i = j
+            continue
+        if c.isdigit() or (c == "." and code[i + 1:i + 2].isdigit()):
+            m = _NUMBER_RE.match(code, i)
+            add("number", m.group(), i)
+            i = m.end()
+            continue
+        if c == '"' or c == "'" and not _is_transpose(
+                p, was_spaced, brackets):
+            j = _skip_string(code, i)
+            add("string", code[i:j], i)
+            i = j
+            continue
+        if c in "([{":
+            brackets.append(c)
+            add("op", c, i)
+            i += 1
+            continue
+        if c in ")]}":
+            if not brackets or brackets.pop() != "([{"[")]}".index(c)]:
+                raise _Unsure("Unbalanced brackets")
+            add("op", c, i)
+            i += 1
+            continue
+        if c in ",;" and not brackets:
+            add("eos", c, i)
+            i += 1
+            continue
+        if code.startswith(".'", i):
+            add("op", ".'", i)
+            i += 2
+            continue
+        add("op", c, i)
+        i += 1
+    if brackets:
+        raise _Unsure("Unbalanced brackets")
+    return tokens
+
+
+def _find_eol(code, i):
+    j = code.find("\n", i)
+    return len(code) if j == -1 else j
+
+
+def _skip_block_comment(code, i, line):
+    # Block comments start and end with lines containing only `%{` / `%}`,
+    # and can be nested.  An unterminated block comment extends to the end.
+    level = 0
+    n = len(code)
+    while i < n:
+        j = _find_eol(code, i)
+        m = _BLOCK_COMMENT_LINE_RE.match(code[i:j])
+        if m:
+            level += 1 if m.group(1) == "{" else -1
+        if level == 0:
+            return j, line
+        i = j + 1
+        line += 1
+    return n, line
+
+
+def _is_transpose(prev, spaced, brackets):
+    if prev is None or prev.kind in ["eos", "command"]:
+        return False
+    value_like = (prev.kind in ["name", "number", "string"]
+                  and prev.text not in _KEYWORDS - {"end"}
+                  or prev.text in [")", "]", "}", "'", ".'"])
+    if not spaced:
+        return value_like
+    # `[a 'b']` is a concatenation; outside brackets `a '` is a transpose.
+    if brackets and brackets[-1] in "[{":
+        return False
+    return value_like
+
+
+def _skip_string(code, i):
+    quote = code[i]
+    j = i + 1
+    n = len(code)
+    while j < n:
+        c = code[j]
+        if c == "\n":
+            raise _Unsure("Unterminated string")
+        if c == quote:
+            if code[j + 1:j + 2] == quote:  # Escaped quote.
+                j += 2
+                continue
+            return j + 1
+        j += 1
+    raise _Unsure("Unterminated string")
+
+
+def _is_command_syntax(code, i):
+    # `name arg` (but not `name = ...`, `name (...)`, `name + x`, ...).
+    if i >= len(code) or code[i] not in " \t":
+        return False
+    rest = code[i:_find_eol(code, i)].lstrip(" \t")
+    if not rest or rest[0] in "\r\n%;,=(":
+        return False
+    if rest.startswith("..."):
+        return False
+    m = re.match(r"(==|~=|<=|>=|&&|\|\||\.\*|\./|\.\\|\.\^|[-+*/\\^<>&|:])"
+                 r"([ \t]|$)", rest)
+    if m:  # Binary operator followed by whitespace.
+        return False
+    if rest[0] in "[{" or rest[0].isdigit():
+        return False
+    return True
+
+
+def _skip_command(code, i):
+    # Command arguments extend to the end of the statement; quotes protect
+    # separators.
+    n = len(code)
+    quoted = False
+    while i < n:
+        c = code[i]
+        if c == "\n":
+            if quoted:
+                raise _Unsure("Unterminated string")
+            return i
+        if c == "'":
+            quoted = not quoted
+        elif not quoted and (c in ",;%"):
+            return i
+        i += 1
+    if quoted:
+        raise _Unsure("Unterminated string")
+    return i
+
+
+def _statements(tokens):
+    statement = []
+    for token in tokens:
+        if token.kind == "eos":
+            if statement:
+                yield statement
+            statement = []
+        else:
+            statement.append(token)
+    if statement:
+        yield statement
+
+
+def _function_name(header):
+    # `function [a, b] = name(...)`, `function a = name(...)`,
+    # `function name(...)`, `function name`.
+    names = header[1:]
+    for k, token in enumerate(names):
+        if token.text == "=" and token.depth == header[0].depth:
+            names = names[k + 1:]
+            break
+    if not names or names[0].kind != "name" or names[0].text in _KEYWORDS:
+        raise _Unsure("Unrecognized function header")
+    if len(names) > 1 and names[1].text == ".":
+        raise _Unsure("Property accessor")
+    return names[0].text
+
+
+def extract_functions(code):
+    """Split outer function definitions out of a cell.
+
+    Returns ``(remaining_code, [(function_name, function_code), ...])``
+    (as `imatlab_extract_functions.m`), or None if the code could not be
+    parsed reliably.
+    """
+    if "function" not in code:
+        return code, []
+    try:
+        tokens = tokenize(code)
+        functions = []  # List of (name, start line, end line).
+        blocks = []
+        for statement in _statements(tokens):
+            for k, token in enumerate(statement):
+                if token.kind != "name" or token.depth:
+                    continue
+                if k and statement[k - 1].text == ".":
+                    continue  # Field access, e.g. `s.end`.
+                word = token.text
+                if word == "classdef":
+                    raise _Unsure("classdef")
+                if word == "arguments" and k == 0:
+                    if (blocks and blocks[-1][0] == "function"
+                            and _ARGUMENTS_RE.match(code, token.start)):
+                        blocks.append((word, token))
+                elif word in _BLOCK_KEYWORDS:
+                    if word == "function" and not blocks:
+                        if k != 0 or code[:token.start].rpartition(
+                                "\n")[2].strip():
+                            raise _Unsure("function not at start of line")
+                        name = _function_name(statement[k:])
+                        blocks.append((word, token, name))
+                    else:
+                        blocks.append((word, token))
+                elif word == "end":
+                    if not blocks:
+                        raise _Unsure("Unmatched end")
+                    block = blocks.pop()
+                    if not blocks and block[0] == "function":
+                        functions.append((block[2], block[1].line, token.line))
+                        _check_rest_of_line(tokens, token)
+        if blocks:
+            raise _Unsure("Unterminated block")
+    except _Unsure:
+        return None
+    if not functions:
+        return code, []
+    lines = code.split("\n")
+    remove = set()
+    extracted = []
+    for name, start, end in functions:
+        extracted.append((name, "\n".join(lines[start:end + 1])))
+        remove.update(range(start, end + 1))
+    remaining = "\n".join(
+        line for i, line in enumerate(lines) if i not in remove)
+    return remaining, extracted
+
+
+def trailing_expression(code):
+    """Split the displayed value at the end of a cell out of it.
+
+    If the last statement of *code* is a name, optionally followed by field
+    accesses and indexing (e.g. ``t`` or ``s.data(1:3, :)``), on a single
+    line, outside of any block, and not terminated by a semicolon (comments
+    aside), returns ``(body, name, expression)``; otherwise, returns None.
+    Whether the name is actually a variable (rather than e.g. a function
+    called without arguments) is only known to MATLAB, so callers must run
+    *expression* as is if it is not.
+    """
+    try:
+        tokens = tokenize(code)
+        end = len(tokens)
+        while end and tokens[end - 1].kind == "eos":
+            if tokens[end - 1].text == ";":
+                return None
+            end -= 1
+        start = end
+        while start and tokens[start - 1].kind != "eos":
+            start -= 1
+        statement = tokens[start:end]
+        if (not statement or statement[0].line != statement[-1].line
+                or not _is_indexing(statement)
+                or _open_blocks(tokens[:start])):
+            return None
+    except _Unsure:
+        return None
+    first, last = statement[0], statement[-1]
+    return (code[:first.start], first.text,
+            code[first.start:last.start + len(last.text)])
+
+
+def _is_indexing(statement):
+    # Only keep the tokens outside of brackets, and the opening brackets.
+    skeleton = "".join(
+        "n" if token.kind == "name" else
+        token.text if token.kind == "op" and token.text in ".(){}" else "?"
+        for token in statement
+        if token.depth == 0 or token.depth == 1 and token.text in "([{")
+    return (statement[0].kind == "name"
+            and statement[0].text not in _KEYWORDS
+            and re.fullmatch(r"n(?:\.n|\(\)|\{\})*", skeleton) is not None)
+
+
+def _open_blocks(tokens):
+    # Whether *tokens* end within a block.
+    depth = 0
+    for statement in _statements(tokens):
+        for k, token in enumerate(statement):
+            if (token.kind != "name" or token.depth
+                    or k and statement[k - 1].text == "."):
+                continue
+            if token.text == "classdef":
+                raise _Unsure("classdef")
+            if token.text in _BLOCK_KEYWORDS:
+                depth += 1
+            elif token.text == "end":
+                depth -= 1
+                if depth < 0:
+                    raise _Unsure("Unmatched end")
+    return depth > 0
+
+
+def _check_rest_of_line(tokens, end_token):
+    # Lines are extracted whole, so nothing but separators may follow the
+    # function's `end` on its line.
+    index = tokens.index(end_token)
+    for token in tokens[index + 1:]:
+        if token.line != end_token.line:
+            break
+        if token.kind != "eos":
+            raise _Unsure("Code after end")
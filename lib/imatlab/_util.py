@@ -0,0 +1,96 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import uuid
+
+
+class LRUCache:
+    """A mapping that keeps at most *maxsize* most recently used entries.
+
+    If *sizeof* is given, entries are weighted by ``sizeof(value)`` instead
+    (e.g. to bound the total number of bytes stored); the most recent entry
+    is always kept.  `put` returns the ``(key, value)`` pairs it evicted.
+    """
+
+    def __init__(self, maxsize, sizeof=None):
+        self._maxsize = maxsize
+        self._sizeof = sizeof or (lambda value: 1)
+        self._data = OrderedDict()
+        self._size = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def put(self, key, value):
+        if key in self._data:
+            self._size -= self._sizeof(self._data[key])
+        self._data[key] = value
+        self._data.move_to_end(key)
+        self._size += self._sizeof(value)
+        evicted = []
+        while self._size > self._maxsize and len(self._data) > 1:
+            evicted.append(self._data.popitem(last=False))
+            self._size -= self._sizeof(evicted[-1][1])
+        return evicted
+
+
+class DisplayTracker:
+    """Track the displays of keyed outputs (e.g. live figures, by number).
+
+    `publish` tells whether data for a key should be sent as a new display,
+    as an update of the key's existing display, or not at all, if it is
+    identical to what that display already shows.
+
+    Displays only persist until `reset`, which the kernel calls at the start
+    of each execution: frontends clear the outputs of a cell when it is
+    re-run, so displays from earlier executions cannot be updated.
+    """
+
+    def __init__(self, prefix):
+        self._prefix = prefix
+        self._displays = {}  # Key -> [display id, digest of shown data].
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._displays
+
+    def reset(self):
+        """Forget all displays (e.g. as the frontend cleared them).
+        """
+        with self._lock:
+            self._displays.clear()
+
+    def publish(self, key, data):
+        """Return ``(action, display_id)`` for sending *data* for *key*.
+
+        *action* is "display", "update", or None if *data* (a mimebundle) is
+        unchanged.
+        """
+        digest = hashlib.sha1()
+        for mimetype in sorted(data):
+            digest.update(mimetype.encode("utf-8") + b"\0")
+            value = data[mimetype]
+            digest.update(value.encode("utf-8") if isinstance(value, str)
+                          else repr(value).encode("utf-8"))
+        digest = digest.digest()
+        with self._lock:
+            display = self._displays.get(key)
+            if display is None:
+                display_id = "{}-{}".format(self._prefix, uuid.uuid4())
+                self._displays[key] = [display_id, digest]
+                return "display", display_id
+            if display[1] == digest:
+                return None, display[0]
+            display[1] = digest
+            return "update", display[0]
@@ -0,0 +1,319 @@
+"""Transfer of numeric and logical arrays between MATLAB and NumPy.
+
+Arrays cross the engine boundary as flat, column-major buffers (see
+`imatlab_get_variable.m` and `imatlab_put_variable.m`), which are viewed as
+NumPy arrays without per-element conversion.  Arrays larger than a threshold
+instead go through a file in a memory-backed folder (``/dev/shm`` where
+available), which NumPy memory-maps.  Complex arrays are transferred as their
+real and imaginary parts, and sparse matrices as their nonzero elements
+(which requires SciPy on the Python side).
+
+Tables and timetables are written by MATLAB to Parquet files (see
+`imatlab_export_table.m`), possibly split in chunks of rows, which pyarrow
+reads (memory-mapped), streams, or converts to Arrow IPC files.  Unlike
+Parquet, IPC files can be memory-mapped without decoding.
+
+NumPy and pyarrow are only imported when a transfer is requested, as they are
+not dependencies of the kernel otherwise.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import uuid
+
+
+# Lines such as `%get x` and `%put y /path/to/y.npy` are comments for MATLAB.
+MAGIC_RE = re.compile(
+    r"^%(get|put)[ \t]+([A-Za-z]\w*)"
+    r"(?:[ \t]+(\S+\.(?:npy|parquet|arrow|feather)))?[ \t]*\r?$", re.M)
+TABLE_SUFFIXES = (".parquet", ".arrow", ".feather")
+
+# MATLAB classes and the corresponding NumPy dtypes.
+_DTYPES = {
+    "double": "float64", "single": "float32", "logical": "bool",
+    "int8": "int8", "int16": "int16", "int32": "int32", "int64": "int64",
+    "uint8": "uint8", "uint16": "uint16", "uint32": "uint32",
+    "uint64": "uint64",
+}
+_CLASSES = {dtype: cls for cls, dtype in _DTYPES.items()}
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("Transferring variables requires NumPy.") from None
+    return numpy
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Transferring tables requires pyarrow.") from None
+    return pyarrow
+
+
+def mmap_dir():
+    """Return the folder used for memory-mapped transfers.
+    """
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def parse_magics(code):
+    """Return the ``(command, name, path)`` of the magics in a cell.
+    """
+    return [m.groups() for m in MAGIC_RE.finditer(code)]
+
+
+def load(path):
+    """Load an array saved with `numpy.save`.
+    """
+    return _numpy().load(path, allow_pickle=False)
+
+
+def save(path, value):
+    """Save a full array with `numpy.save`.
+    """
+    np = _numpy()
+    if not isinstance(value, np.ndarray):
+        raise TypeError("Only full arrays can be saved to .npy files.")
+    np.save(path, value, allow_pickle=False)
+
+
+def describe(value):
+    """Return a one-line description of a transferred array.
+    """
+    if hasattr(value, "schema"):
+        return "{} x {} table".format(value.num_rows, value.num_columns)
+    shape = " x ".join(map(str, value.shape))
+    if hasattr(value, "nnz"):
+        return "{} sparse {} ({} nonzeros)".format(
+            shape, value.dtype, value.nnz)
+    return "{} {}".format(shape, value.dtype)
+
+
+def _buffer(np, value, dtype):
+    # View an engine array (or a scalar) as a flat NumPy array.
+    if isinstance(value, (int, float, bool)):
+        return np.array([value], dtype)
+    try:
+        array = np.asarray(memoryview(value))
+    except TypeError:
+        # Engines that predate the buffer protocol store the elements of
+        # their arrays in an `array.array`.
+        array = np.frombuffer(value._data, value._data.typecode)
+    # The arrays are vectors, so the memory order does not matter.
+    return array.reshape(-1).astype(dtype, copy=False)
+
+
+def to_numpy(spec):
+    """Build a NumPy array from the output of `imatlab_get_variable.m`.
+    """
+    np = _numpy()
+    cls = spec["class"]
+    dtype = _DTYPES[cls]
+    shape = tuple(_buffer(np, spec["size"], "intp"))
+    if spec["sparse"]:
+        try:
+            import scipy.sparse
+        except ImportError:
+            raise ImportError(
+                "Transferring sparse matrices requires SciPy.") from None
+        values = _buffer(np, spec["real"], dtype)
+        if spec["complex"]:
+            values = _complex(np, values, _buffer(np, spec["imag"], dtype))
+        rows = _buffer(np, spec["rows"], "intp") - 1
+        cols = _buffer(np, spec["cols"], "intp") - 1
+        return scipy.sparse.csc_matrix((values, (rows, cols)), shape=shape)
+    if "file" in spec:
+        path = spec["file"]
+        count = int(np.prod(shape))
+        # Logical arrays are written as uint8, which bool maps as is.
+        raw = np.memmap(path, dtype=dtype, mode="r",
+                        shape=(2 if spec["complex"] else 1) * count)
+        try:
+            # The mapping remains valid once the file is unlinked.
+            os.unlink(path)
+        except OSError:
+            # Windows does not allow deleting mapped files.
+            raw = np.array(raw)
+            os.unlink(path)
+        array = (_complex(np, raw[:count], raw[count:]) if spec["complex"]
+                 else raw)
+        return array.reshape(shape, order="F")
+    array = _buffer(np, spec["real"], dtype)
+    if spec["complex"]:
+        array = _complex(np, array, _buffer(np, spec["imag"], dtype))
+    return array.reshape(shape, order="F")
+
+
+def _complex(np, real, imag):
+    array = np.empty(real.shape, np.result_type(real.dtype, np.complex64))
+    array.real = real
+    array.imag = imag
+    return array
+
+
+def _matlab_array(np, array):
+    # Wrap a flat NumPy array in the matching matlab.* type.
+    import matlab
+    cls = getattr(matlab, _CLASSES[array.dtype.name])
+    try:
+        # Recent engines accept buffers directly.
+        return cls(array)
+    except TypeError:
+        return cls(array.tolist())
+
+
+def from_numpy(value, mmap_bytes, directory=None):
+    """Build the input of `imatlab_put_variable.m` from a NumPy array.
+
+    Arrays of more than *mmap_bytes* are written to a file in *directory*
+    (by default, `mmap_dir()`), which MATLAB reads and deletes.
+    """
+    np = _numpy()
+    try:
+        import scipy.sparse
+    except ImportError:
+        scipy = None
+    if scipy is not None and scipy.sparse.issparse(value):
+        coo = value.tocoo()
+        is_bool = coo.dtype == np.bool_
+        values = coo.data.astype(
+            "bool" if is_bool else "complex128" if np.iscomplexobj(coo.data)
+            else "float64", copy=False)
+        spec = {"class": "logical" if is_bool else "double",
+                "size": matlab_size(coo.shape),
+                "complex": np.iscomplexobj(values), "sparse": True,
+                "rows": _matlab_array(np, (coo.row + 1).astype("float64")),
+                "cols": _matlab_array(np, (coo.col + 1).astype("float64"))}
+        _put_parts(np, spec, values)
+        return spec
+    array = np.asarray(value)
+    complex_ = np.iscomplexobj(array)
+    real_dtype = array.real.dtype if complex_ else array.dtype
+    if real_dtype.name not in _CLASSES:
+        raise TypeError(
+            "Cannot transfer arrays of dtype {}.".format(array.dtype))
+    spec = {"class": _CLASSES[real_dtype.name],
+            "size": matlab_size(array.shape),
+            "complex": complex_, "sparse": False}
+    if array.nbytes > mmap_bytes:
+        fd, path = tempfile.mkstemp(
+            dir=directory or mmap_dir(), suffix=".bin")
+        os.close(fd)
+        count = array.size
+        raw = np.memmap(path, dtype=real_dtype.name, mode="w+",
+                        shape=max((2 if complex_ else 1) * count, 1))
+        raw[:count] = array.real.reshape(-1, order="F")
+        if complex_:
+            raw[count:] = array.imag.reshape(-1, order="F")
+        raw.flush()
+        del raw
+        spec["file"] = path
+        return spec
+    _put_parts(np, spec, array.reshape(-1, order="F"))
+    return spec
+
+
+def _put_parts(np, spec, values):
+    if spec["complex"]:
+        spec["real"] = _matlab_array(np, np.ascontiguousarray(values.real))
+        spec["imag"] = _matlab_array(np, np.ascontiguousarray(values.imag))
+    else:
+        spec["real"] = _matlab_array(np, np.ascontiguousarray(values))
+
+
+def matlab_size(shape):
+    """Return the MATLAB size (with at least two dimensions) of a shape.
+    """
+    import matlab
+    shape = tuple(shape)
+    if len(shape) == 0:
+        shape = (1, 1)
+    elif len(shape) == 1:
+        shape = (1,) + shape
+    return matlab.double([list(map(float, shape))])
+
+
+def temp_path(suffix):
+    """Return a new path, in the temporary folder, for an exported table.
+    """
+    # Not in /dev/shm, as tables may not fit in memory.
+    return os.path.join(tempfile.gettempdir(),
+                        "imatlab_{}{}".format(uuid.uuid4().hex, suffix))
+
+
+def remove(path):
+    """Remove an exported table (a file or a folder of chunks), if present.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _parquet_files(path):
+    # A table exported in chunks is a folder of sorted part files.
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.endswith(".parquet")]
+    return [path]
+
+
+def iter_batches(path, remove_parts=False):
+    """Iterate over the record batches of an exported Parquet table.
+
+    Only one row group is decoded at a time.  If *remove_parts* is set, each
+    part file is removed once read.
+    """
+    pa = _pyarrow()
+    for file in _parquet_files(path):
+        # Decoded batches do not reference the mapping.
+        with pa.memory_map(file) as source:
+            yield from pa.parquet.ParquetFile(source).iter_batches()
+        if remove_parts:
+            os.remove(file)
+
+
+def parquet_to_ipc(source, dest):
+    """Convert an exported Parquet table to an Arrow IPC file, batch by batch.
+    """
+    pa = _pyarrow()
+    files = _parquet_files(source)
+    if not files:
+        raise ValueError("No Parquet files in {}.".format(source))
+    schema = pa.parquet.read_schema(files[0])
+    with pa.OSFile(dest, "wb") as sink, \
+            pa.ipc.new_file(sink, schema) as writer:
+        for batch in iter_batches(source):
+            writer.write_batch(batch)
+
+
+def read_table(path, remove_file=False):
+    """Read an exported table as a `pyarrow.Table`.
+
+    Arrow IPC files are memory-mapped, so that the table is backed by the file
+    rather than by a copy; Parquet files are memory-mapped while decoded.  If
+    *remove_file* is set, the file is removed once read.
+    """
+    pa = _pyarrow()
+    if not path.endswith((".arrow", ".feather")):
+        table = pa.parquet.read_table(path, memory_map=True)
+        if remove_file:
+            remove(path)
+        return table
+    if remove_file and os.name == "nt":
+        # Windows does not allow deleting mapped files.
+        with pa.OSFile(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+    else:
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    if remove_file:
+        # The mapping remains valid once the file is unlinked.
+        remove(path)
+    return table
@@ -0,0 +1,20 @@
+function imatlab_bootstrap(funcDir)
+    % IMATLAB_BOOTSTRAP Initialize a MATLAB session for the imatlab kernel.
+    %
+    %   IMATLAB_BOOTSTRAP(funcDir)
+    %     flags the session as running in Jupyter, runs startupJupyter (if
+    %     present) in the base workspace, and prepends funcDir (the folder
+    %     holding function definitions extracted from cells) to the path.
+    %
+    %   This is called by the kernel in a single round trip, right after
+    %   adding the imatlab resources folder to the path.
+
+    % set env var to let Matlab code know its in Jupyter kernel
+    setenv('JUPYTER_KERNEL', 'imatlab');
+
+    evalin('base', 'try, startupJupyter, catch, end');
+
+    if nargin >= 1 && ~isempty(funcDir)
+        addpath(funcDir, '-begin');
+    end
+end
@@ -0,0 +1,62 @@
+function restore = imatlab_decimate_lines(fig, maxPoints)
+    % IMATLAB_DECIMATE_LINES Temporarily decimate the lines of a figure.
+    %
+    %   restore = IMATLAB_DECIMATE_LINES(fig, maxPoints)
+    %     replaces the data of each 2D line of fig that has more than
+    %     maxPoints points by the minimum and the maximum of each of
+    %     maxPoints/2 buckets of consecutive points, which keeps the envelope
+    %     of the line as drawn with that many pixel columns.  Buckets that
+    %     contain NaNs also keep their first NaN, so that gaps in the line
+    %     are not bridged.  Lines whose YData is not floating point (e.g.
+    %     integers, datetimes or durations) are left unchanged.  If maxPoints
+    %     is 'auto', twice the width in pixels of the line's axes is used.
+    %     restore is an onCleanup object that puts the original data back
+    %     when it is destroyed.
+
+    lines = findall(fig, 'Type', 'line');
+    saved = cell(numel(lines), 1);
+    for i = 1:numel(lines)
+        line = lines(i);
+        y = line.YData;
+        n = numel(y);
+        budget = maxPoints;
+        if strcmp(budget, 'auto')
+            position = getpixelposition(ancestor(line, 'axes'));
+            budget = 2 * ceil(position(3));
+        end
+        if n <= budget || ~isempty(line.ZData) || budget < 2 || ~isfloat(y)
+            continue
+        end
+        x = line.XData;
+        saved{i} = {x, y, line.XDataMode};
+        % Points per bucket, and number of buckets.
+        k = ceil(n / floor(budget / 2));
+        m = ceil(n / k);
+        padded = nan(k * m, 1);
+        padded(1:n) = y;
+        buckets = reshape(padded, k, m);
+        % min and max ignore NaNs, so the padding is never selected.
+        [~, iMin] = min(buckets, [], 1);
+        [~, iMax] = max(buckets, [], 1);
+        % The first NaN of each bucket (excluding the padding).
+        gaps = false(k * m, 1);
+        gaps(1:n) = isnan(y);
+        [hasGap, iGap] = max(reshape(gaps, k, m), [], 1);
+        offsets = (0:m - 1) * k;
+        % Keep both extrema (and the gap) of each bucket, in their original
+        % order.
+        idx = unique([iMin + offsets, iMax + offsets, ...
+                      iGap(hasGap) + offsets(hasGap)]);
+        set(line, 'XData', x(idx), 'YData', y(idx));
+    end
+    restore = onCleanup(@() restoreLines(lines, saved));
+end
+
+function restoreLines(lines, saved)
+    for i = 1:numel(lines)
+        if ~isempty(saved{i}) && isvalid(lines(i))
+            set(lines(i), 'XData', saved{i}{1}, 'YData', saved{i}{2}, ...
+                'XDataMode', saved{i}{3});
+        end
+    end
+end
@@ -0,0 +1,154 @@
+function preview = imatlab_display_value(action, expression, maxRows, maxCols)
+    % IMATLAB_DISPLAY_VALUE Display the value a cell ends with as a preview.
+    %
+    %   IMATLAB_DISPLAY_VALUE('capture', expression, maxRows, maxCols)
+    %     evaluates expression (the name of a variable of the base
+    %     workspace, possibly followed by field accesses and indexing) in the
+    %     base workspace, in place of the last statement of a cell.  If its
+    %     value is an array with more than maxRows rows or maxCols columns
+    %     (or more than maxRows*maxCols elements), at most the first and last
+    %     maxRows/2 rows and maxCols/2 columns of its first page are rendered
+    %     as HTML and text, and kept for the 'take' action.  Other values
+    %     (e.g. small arrays, scalars and structs) are displayed as usual.  As
+    %     for the original statement, ans is set unless expression is a name.
+    %
+    %   preview = IMATLAB_DISPLAY_VALUE('take')
+    %     returns, and forgets, the last captured preview: a struct with the
+    %     fields html and text, or an empty struct if there is none.
+
+    key = 'imatlab_display_value';
+    if strcmp(action, 'take')
+        preview = struct();
+        if isappdata(groot, key)
+            preview = getappdata(groot, key);
+            rmappdata(groot, key);
+        end
+        return
+    end
+
+    try
+        capture(key, expression, maxRows, maxCols);
+    catch err
+        % Report errors as the original statement would.
+        throwAsCaller(err);
+    end
+end
+
+function capture(key, expression, maxRows, maxCols)
+    name = regexp(expression, '^[A-Za-z]\w*', 'match', 'once');
+    value = evalin('base', expression);
+    if ~strcmp(expression, name)
+        name = 'ans';
+        assignin('base', name, value);
+    end
+    if ~previewable(value, maxRows, maxCols)
+        evalin('base', name);
+        return
+    end
+    setappdata(groot, key, render(name, value, maxRows, maxCols));
+end
+
+function tf = previewable(value, maxRows, maxCols)
+    % Only values that MATLAB would display at length.
+    if size(value, 1) <= maxRows && size(value, 2) <= maxCols ...
+            && numel(value) <= maxRows * maxCols
+        tf = false;
+    elseif istable(value) || istimetable(value)
+        tf = true;
+    elseif ischar(value) && isrow(value)
+        tf = false;
+    else
+        tf = isnumeric(value) || islogical(value) || ischar(value) ...
+             || isstring(value) || iscell(value) || iscategorical(value) ...
+             || isdatetime(value) || isduration(value);
+    end
+end
+
+function preview = render(name, value, maxRows, maxCols)
+    dims = strjoin(arrayfun(@num2str, size(value), 'UniformOutput', false), ...
+                   char(215));
+    caption = sprintf('%s: %s %s', name, dims, class(value));
+    if ~ismatrix(value)
+        value = value(:, :, 1);
+        caption = [caption, ', page (:, :, 1)'];
+    end
+    if ischar(value)
+        % Render each row of char matrices as a whole.
+        value = cellstr(value);
+    end
+    [rows, rowGap] = window(size(value, 1), maxRows);
+    [cols, colGap] = window(size(value, 2), maxCols);
+    part = value(rows, cols);
+    if istable(value) || istimetable(value)
+        header = part.Properties.VariableNames;
+        if istimetable(value)
+            labels = cellstr(string(part.Properties.RowTimes));
+        elseif ~isempty(part.Properties.RowNames)
+            labels = part.Properties.RowNames;
+        else
+            labels = arrayfun(@num2str, rows, 'UniformOutput', false);
+        end
+    else
+        header = arrayfun(@num2str, cols, 'UniformOutput', false);
+        labels = arrayfun(@num2str, rows, 'UniformOutput', false);
+    end
+    cells = imatlab_format_cells(part);
+    header = reshape(header, 1, []);
+    labels = reshape(labels, 1, []);
+    % Mark the omitted rows and columns.
+    if colGap
+        hdots = char(8230);
+        cells = [cells(:, 1:colGap), repmat({hdots}, size(cells, 1), 1), ...
+                 cells(:, colGap+1:end)];
+        header = [header(1:colGap), {hdots}, header(colGap+1:end)];
+    end
+    if rowGap
+        vdots = char(8942);
+        cells = [cells(1:rowGap, :); repmat({vdots}, 1, size(cells, 2)); ...
+                 cells(rowGap+1:end, :)];
+        labels = [labels(1:rowGap), {vdots}, labels(rowGap+1:end)];
+    end
+
+    escaped = escape(header);
+    html = {'<div class="imatlab-value"><p><code>', ...
+            escape(caption), '</code></p><table><thead><tr><th></th>', ...
+            sprintf('<th>%s</th>', escaped{:}), '</tr></thead><tbody>'};
+    for i = 1:size(cells, 1)
+        row = escape(cells(i, :));
+        html = [html, {'<tr><th>', escape(labels{i}), '</th>', ...
+                       sprintf('<td>%s</td>', row{:}), '</tr>'}];  %#ok<AGROW>
+    end
+    html = strjoin([html, {'</tbody></table></div>'}], '');
+
+    % Right-aligned, fixed-width columns for the text fallback.
+    grid = [[{''}, header]; [labels', cells]];
+    widths = max(cellfun(@numel, grid), [], 1);
+    lines = cell(1, size(grid, 1));
+    for i = 1:size(grid, 1)
+        lines{i} = strjoin(arrayfun( ...
+            @(j) sprintf('%*s', widths(j), grid{i, j}), ...
+            1:size(grid, 2), 'UniformOutput', false), '  ');
+    end
+    preview = struct('html', html, ...
+                     'text', strjoin([{caption, ''}, lines], newline));
+end
+
+function [indices, gap] = window(n, maxCount)
+    % The first and last maxCount/2 indices, and the position of the gap
+    % between them (0 if none).
+    if n <= maxCount
+        indices = 1:n;
+        gap = 0;
+    else
+        head = ceil(maxCount / 2);
+        indices = [1:head, n - (maxCount - head) + 1 : n];
+        gap = head;
+    end
+end
+
+function text = escape(text)
+    % Works on char rows and cell arrays thereof.
+    text = strrep(text, '&', '&amp;');
+    text = strrep(text, '<', '&lt;');
+    text = strrep(text, '>', '&gt;');
+end
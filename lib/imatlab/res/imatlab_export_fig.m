@@ -3,39 +3,23 @@ function exported = imatlab_export_fig(exporter)
     %
     %   IMATLAB_EXPORT_FIG(exporter)
     %     where exporter is one of
-    %       {'', 'fig2plotly', 'print-jpeg', 'print-png'}
+    %       {'', 'fig2plotly', 'print-jpeg', 'print-png', 'print-svg',
+    %        'memory-png', 'memory-jpeg'}
     %     sets the current exporter.
     %
     %   exported = IMATLAB_EXPORT_FIG
-    %     orders the current figures by number, exports and closes them, and
-    %     returns a cell array of exported filenames.
+    %     orders the figures created during the cell by number, exports and
+    %     closes them, and returns a cell array of exported filenames, or,
+    %     for the memory-* and fig2plotly exporters, of structs describing
+    %     the figures (see imatlab_export_figure).
 
     set_exporter = getenv('IMATLAB_FIGURE_EXPORTER');
     if isempty(set_exporter)
         set_exporter = '';
     end
-    valid_exporters = {'', 'fig2plotly', 'print-png', 'print-jpeg', 'print-svg'};
+    valid_exporters = {'', 'fig2plotly', 'print-png', 'print-jpeg', 'print-svg', ...
+                       'memory-png', 'memory-jpeg'};
 
-    % determine real screen DPI
-    screenDPI = getenv('SCREEN_DPI');
-    if ~isempty(screenDPI)
-        screenDPI = str2double(screenDPI);
-    else
-        screenDPI = java.awt.Toolkit.getDefaultToolkit().getScreenResolution();
-    end
-    if isnan(screenDPI)
-        screenDPI = 0;
-    end
-    
-    scale = getenv('FIGURE_SIZE_SCALE');
-    if isempty(scale)
-        scale = 1;
-    else
-        scale = str2double(scale);
-    end
-    screenDPI = screenDPI / scale;
-%     displayDPI = 72;
-    
     if exist('exporter', 'var')
         if any(strcmp(exporter, valid_exporters))
             if strcmp(exporter, 'fig2plotly')
@@ -55,83 +39,13 @@ function exported = imatlab_export_fig(exporter)
                            'UniformOutput', false), ', ')]);
         end
     else
-        children = get(0, 'children');
-        [~, idx] = sort([children.Number]);
-        children = children(idx);
-
-        % ignore figures marked (these were visible before the kernel executed this block of code)
-        mask_save = true(numel(children), 1);
-        mask_close = true(numel(children), 1);
-        for iF = 1:numel(children)
-            ud = children(iF).UserData;
-            if isstruct(ud)
-                if isfield(ud, 'imatlab_ignore') && ud.imatlab_ignore
-                    mask_save(iF) = false;
-                    mask_close(iF) = false;
-                    continue;
-                end
-            end
-            if isempty(children(iF).Children)
-                % don't save empty plots, which includes the one created by imatlab_pre_execute
-                mask_save(iF) = false;
-                mask_close(iF);
-            end
+        numbers = [];
+        if ~isempty(set_exporter)
+            numbers = imatlab_pending_figures();
         end
-        
-        % close figures in mask_close but not mask_save
-        for i = 1:numel(children)
-            if mask_close(i) && ~mask_save(i)
-                close(i);
-            end
-        end
-        
-        % now trim to mask_save
-        children = children(mask_save);
-
-        switch set_exporter
-        case ''
-            exported = {};
-        case 'fig2plotly'
-            exported = cell(1, numel(children));
-            for i = 1:numel(children)
-                name = tempname('.');
-                exported{i} = [name, '.html'];
-                try
-                    fig2plotly(children(i), 'filename', name, ...
-                               'offline', true, 'open', false);
-                catch me
-                    warning('fig2plotly failed to export a figure');
-                    rethrow(me);
-                end
-                close(children(i));
-            end
-        case 'print-png'
-            exported = cell(1, numel(children));
-            for i = 1:numel(children)
-                name = tempname('.');
-                exported{i} = [name, '.png'];
-                % Use screen resolution.
-                print(children(i), exported{i}, '-dpng', sprintf('-r%d', screenDPI));
-                close(children(i));
-            end
-        case 'print-svg'
-            exported = cell(1, numel(children));
-            for i = 1:numel(children)
-                name = tempname('.');
-                exported{i} = [name, '.svg'];
-                % Use screen resolution.
-                print(children(i), exported{i}, '-dsvg', sprintf('-r%d', screenDPI));
-                close(children(i));
-            end
-        case 'print-jpeg'
-            exported = cell(1, numel(children));
-            for i = 1:numel(children)
-                name = tempname('.');
-                exported{i} = [name, '.jpg'];
-                % Use screen resolution.
-                print(children(i), name, '-djpeg', sprintf('-r%d', screenDPI));
-                close(children(i));
-            end
+        exported = cell(1, numel(numbers));
+        for i = 1:numel(numbers)
+            exported{i} = imatlab_export_figure(numbers(i), '.');
         end
     end
 end
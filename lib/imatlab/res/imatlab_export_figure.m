@@ -0,0 +1,90 @@
+function exported = imatlab_export_figure(number, exportDir)
+    % IMATLAB_EXPORT_FIGURE Export and close a single figure for imatlab.
+    %
+    %   exported = IMATLAB_EXPORT_FIGURE(number, exportDir)
+    %     exports figure number with the current exporter (see
+    %     imatlab_export_fig) and closes it.  File-based exporters write to
+    %     exportDir and return the filename; the memory-* exporters return a
+    %     struct with the fields format, width, height and pixels (a uint8
+    %     row vector of interleaved RGB values, row by row); fig2plotly
+    %     returns a struct with the fields format ('plotly') and json (the
+    %     figure's data and layout).
+
+    exporter = getenv('IMATLAB_FIGURE_EXPORTER');
+    % (figure(number) would make the figure visible.)
+    fig = findobj(get(groot, 'Children'), 'flat', 'Number', number);
+    closeFig = onCleanup(@() close(fig));
+
+    % determine real screen DPI
+    screenDPI = getenv('SCREEN_DPI');
+    if ~isempty(screenDPI)
+        screenDPI = str2double(screenDPI);
+    else
+        screenDPI = java.awt.Toolkit.getDefaultToolkit().getScreenResolution();
+    end
+    if isnan(screenDPI)
+        screenDPI = 0;
+    end
+
+    scale = getenv('FIGURE_SIZE_SCALE');
+    if isempty(scale)
+        scale = 1;
+    else
+        scale = str2double(scale);
+    end
+    screenDPI = screenDPI / scale;
+%     displayDPI = 72;
+
+    if startsWith(exporter, 'print-')
+        name = tempname(exportDir);
+    end
+    switch exporter
+    case 'fig2plotly'
+        % Only convert the figure (as fig2plotly does), and return the
+        % figure's JSON, which the kernel displays; writing a standalone
+        % HTML file would embed the whole plotly.js library in each figure.
+        maxPoints = getenv('IMATLAB_PLOTLY_MAX_POINTS');
+        if ~strcmp(maxPoints, 'auto')
+            maxPoints = str2double(maxPoints);
+        end
+        if ~isnan(maxPoints)
+            % The original data is restored when restoreLines is cleared.
+            restoreLines = imatlab_decimate_lines(fig, maxPoints); %#ok<NASGU>
+        end
+        try
+            p = plotlyfig(fig, 'offline', true, 'open', false);
+            if exist('m2json', 'file')
+                json = ['{"data": ', m2json(p.data), ...
+                        ', "layout": ', m2json(p.layout), '}'];
+            else
+                json = jsonencode(struct('data', {p.data}, 'layout', p.layout));
+            end
+        catch me
+            warning('fig2plotly failed to export a figure');
+            rethrow(me);
+        end
+        exported = struct('format', 'plotly', 'json', json);
+    case 'print-png'
+        exported = [name, '.png'];
+        % Use screen resolution.
+        print(fig, exported, '-dpng', sprintf('-r%d', screenDPI));
+    case 'print-svg'
+        exported = [name, '.svg'];
+        print(fig, exported, '-dsvg', sprintf('-r%d', screenDPI));
+    case 'print-jpeg'
+        exported = [name, '.jpg'];
+        print(fig, name, '-djpeg', sprintf('-r%d', screenDPI));
+    case {'memory-png', 'memory-jpeg'}
+        % Capture the pixels directly; the kernel encodes them.  Permuting
+        % the height x width x 3 image to 3 x width x height makes MATLAB's
+        % column-major order interleaved RGB, row by row.
+        img = print(fig, '-RGBImage', sprintf('-r%d', screenDPI));
+        exported = struct( ...
+            'format', exporter(numel('memory-') + 1:end), ...
+            'width', size(img, 2), ...
+            'height', size(img, 1), ...
+            'pixels', reshape(permute(img, [3 2 1]), 1, []));
+    otherwise
+        exported = {};
+    end
+end
@@ -0,0 +1,32 @@
+function imatlab_export_table(name, path, chunkRows)
+    % IMATLAB_EXPORT_TABLE Write a base workspace table to Parquet.
+    %
+    %   IMATLAB_EXPORT_TABLE(name, path, chunkRows)
+    %     writes the table or timetable name to the Parquet file path.  If
+    %     chunkRows is positive and the table has more rows, path is instead
+    %     created as a folder, in which each chunk of chunkRows rows is
+    %     written to its own part-NNNNN.parquet file, so that only one chunk
+    %     is copied at a time.
+
+    value = evalin('base', name);
+    if ~(istable(value) || istimetable(value))
+        error('imatlab:unsupportedType', ...
+              'Only tables and timetables can be exported, not %s.', ...
+              class(value));
+    end
+    if isempty(which('parquetwrite'))
+        error('imatlab:unsupported', ...
+              'Exporting tables requires parquetwrite (MATLAB R2019a+).');
+    end
+    n = height(value);
+    if chunkRows <= 0 || n <= chunkRows
+        parquetwrite(path, value);
+        return
+    end
+    mkdir(path);
+    for k = 1:ceil(n / chunkRows)
+        rows = (k - 1) * chunkRows + 1 : min(k * chunkRows, n);
+        parquetwrite(fullfile(path, sprintf('part-%05d.parquet', k - 1)), ...
+                     value(rows, :));
+    end
+end
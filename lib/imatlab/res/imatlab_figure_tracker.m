@@ -0,0 +1,63 @@
+function result = imatlab_figure_tracker(action, closeHidden)
+    % IMATLAB_FIGURE_TRACKER Track the figures created during a cell.
+    %
+    %   IMATLAB_FIGURE_TRACKER('reset', closeHidden)
+    %     forgets the figures created so far, first installing a listener
+    %     on groot's ObjectChildAdded event if needed.  If closeHidden is
+    %     true, the figures tracked so far that are still open and hidden
+    %     (and have HandleVisibility 'on') are closed first: these are
+    %     figures whose export did not happen, e.g. because the cell was
+    %     interrupted or the export failed, and which would otherwise
+    %     accumulate.
+    %
+    %   figures = IMATLAB_FIGURE_TRACKER('figures')
+    %     returns the figures created since the last reset that still exist.
+    %
+    %   tf = IMATLAB_FIGURE_TRACKER('any')
+    %     returns whether any figure was created since the last reset.
+    %
+    %   The state is kept in groot's application data, so that it survives
+    %   "clear all".
+
+    key = 'imatlab_figure_tracker';
+    switch action
+    case 'reset'
+        state = struct('listener', [], 'figures', gobjects(0));
+        if isappdata(groot, key)
+            state = getappdata(groot, key);
+        end
+        if isempty(state.listener) || ~isvalid(state.listener)
+            state.listener = addlistener( ...
+                groot, 'ObjectChildAdded', @(~, event) onChildAdded(event));
+        end
+        if nargin > 1 && closeHidden
+            leftover = state.figures(isvalid(state.figures));
+            leftover = leftover(strcmp({leftover.Visible}, 'off') ...
+                                & strcmp({leftover.HandleVisibility}, 'on'));
+            if ~isempty(leftover)
+                close(leftover);
+            end
+        end
+        state.figures = gobjects(0);
+        setappdata(groot, key, state);
+    case 'figures'
+        result = gobjects(0);
+        if isappdata(groot, key)
+            state = getappdata(groot, key);
+            result = state.figures(isvalid(state.figures));
+        end
+    case 'any'
+        result = false;
+        if isappdata(groot, key)
+            state = getappdata(groot, key);
+            result = ~isempty(state.figures);
+        end
+    end
+end
+
+function onChildAdded(event)
+    key = 'imatlab_figure_tracker';
+    state = getappdata(groot, key);
+    state.figures(end + 1) = event.Child;
+    setappdata(groot, key, state);
+end
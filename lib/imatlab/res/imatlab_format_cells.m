@@ -0,0 +1,47 @@
+function cells = imatlab_format_cells(window)
+    % IMATLAB_FORMAT_CELLS Render the elements of a 2-D window as text.
+    %
+    %   cells = IMATLAB_FORMAT_CELLS(window)
+    %     returns a cell array of the size of window (or, for tables, of
+    %     height(window) x width(window)) holding each element (or table
+    %     cell) rendered as a char row.  Scalars are rendered as values,
+    %     other elements as a [size class] summary.
+
+    if istable(window) || istimetable(window)
+        cells = cell(height(window), width(window));
+        for j = 1:width(window)
+            column = window.(j);
+            for i = 1:height(window)
+                cells{i, j} = render(column(i, :));
+            end
+        end
+    else
+        cells = cell(size(window));
+        for k = 1:numel(window)
+            cells{k} = render(window(k));
+        end
+    end
+end
+
+function text = render(x)
+    if iscell(x) && isscalar(x)
+        x = x{1};
+    end
+    if (isnumeric(x) || islogical(x)) && isscalar(x)
+        text = num2str(x);
+    elseif ischar(x) && (isrow(x) || isempty(x)) && numel(x) <= 200
+        text = x;
+    elseif isstring(x) && isscalar(x)
+        if ismissing(x)
+            text = '<missing>';
+        else
+            text = char(x);
+        end
+    elseif (isdatetime(x) || isduration(x) || iscategorical(x)) ...
+            && isscalar(x)
+        text = char(string(x));
+    else
+        dims = sprintf('%dx', size(x));
+        text = sprintf('[%s %s]', dims(1:end-1), class(x));
+    end
+end
@@ -0,0 +1,67 @@
+function out = imatlab_get_variable(name, mmapDir, mmapBytes)
+    % IMATLAB_GET_VARIABLE Prepare a base workspace variable for transfer.
+    %
+    %   out = IMATLAB_GET_VARIABLE(name, mmapDir, mmapBytes)
+    %     returns a struct describing the numeric or logical variable name,
+    %     with the fields class, size, complex and sparse, and:
+    %       - for sparse matrices, rows, cols, real (and imag): the (1-based)
+    %         indices and the values of the nonzero elements;
+    %       - for full arrays larger than mmapBytes, if mmapDir is not empty,
+    %         file: a file in mmapDir holding the real part (then the
+    %         imaginary part) of the array in column-major order, which the
+    %         caller memory-maps and deletes;
+    %       - otherwise, real (and imag): the real (and imaginary) part, as
+    %         a row vector in column-major order.
+    %     For tables and timetables, out only has the class field.
+
+    value = evalin('base', name);
+    if istable(value) || istimetable(value)
+        % Transferred by imatlab_export_table instead.
+        out = struct('class', class(value));
+        return
+    end
+    if ~(isnumeric(value) || islogical(value))
+        error('imatlab:unsupportedType', ...
+              'Only numeric and logical arrays can be transferred, not %s.', ...
+              class(value));
+    end
+    out = struct('class', class(value), 'size', size(value), ...
+                 'complex', ~isreal(value), 'sparse', issparse(value));
+    if out.sparse
+        [rows, cols, values] = find(value);
+        out.rows = rows;
+        out.cols = cols;
+        [out.real, out.imag] = parts(values);
+        return
+    end
+    info = whos('value');
+    if ~isempty(mmapDir) && info.bytes > mmapBytes
+        precision = out.class;
+        if islogical(value)
+            precision = 'uint8';
+        end
+        out.file = [tempname(mmapDir), '.bin'];
+        fid = fopen(out.file, 'w');
+        if fid < 0
+            error('imatlab:transferFailed', 'Cannot create %s.', out.file);
+        end
+        closeFile = onCleanup(@() fclose(fid));
+        [re, im] = parts(value);
+        fwrite(fid, re, precision);
+        fwrite(fid, im, precision);
+        return
+    end
+    % Flat vectors have the same layout whatever the engine's array order.
+    [out.real, out.imag] = parts(reshape(value, 1, []));
+end
+
+function [re, im] = parts(value)
+    % real and imag are not defined for logical arrays.
+    if isreal(value)
+        re = value;
+        im = [];
+    else
+        re = real(value);
+        im = imag(value);
+    end
+end
@@ -0,0 +1,55 @@
+function live = imatlab_live_figures(liveDir, interval)
+    % IMATLAB_LIVE_FIGURES Periodically snapshot figures while a cell runs.
+    %
+    %   live = IMATLAB_LIVE_FIGURES(liveDir, interval)
+    %     starts a timer that writes a png snapshot of each figure created
+    %     during the cell (see imatlab_figure_tracker) to liveDir, as
+    %     <number>.png, every interval seconds or more.  Snapshots are
+    %     written to a temporary file first, then renamed.  To keep the
+    %     overhead on the computation low, snapshots are spaced so that at
+    %     most a tenth of the time is spent taking them.  The timer is
+    %     deleted when live is destroyed.
+    %
+    %   As for all timers, snapshots are only taken when MATLAB processes
+    %   events, e.g. in drawnow or pause.
+
+    t = timer('Name', 'imatlab_live_figures', ...
+              'ExecutionMode', 'fixedSpacing', 'Period', interval, ...
+              'BusyMode', 'drop', ...
+              'UserData', struct('clock', tic, 'next', 0), ...
+              'TimerFcn', @(t, ~) snapshot(t, liveDir));
+    start(t);
+    live = onCleanup(@() deleteTimer(t));
+end
+
+function snapshot(t, liveDir)
+    state = t.UserData;
+    started = toc(state.clock);
+    if started < state.next
+        return
+    end
+    try
+        figures = imatlab_figure_tracker('figures');
+        for iF = 1:numel(figures)
+            fig = figures(iF);
+            if strcmp(fig.HandleVisibility, 'on') && ~isempty(fig.Children)
+                tmp = fullfile(liveDir, sprintf('.%d.png', fig.Number));
+                print(fig, tmp, '-dpng', '-r0');
+                movefile(tmp, fullfile(liveDir, sprintf('%d.png', fig.Number)), 'f');
+            end
+        end
+    catch
+        % Snapshots are best-effort; the figures are exported at the end of
+        % the cell anyway.
+    end
+    finished = toc(state.clock);
+    state.next = finished + 9 * (finished - started);
+    t.UserData = state;
+end
+
+function deleteTimer(t)
+    if isvalid(t)
+        stop(t);
+        delete(t);
+    end
+end
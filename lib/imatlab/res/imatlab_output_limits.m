@@ -0,0 +1,31 @@
+function limits = imatlab_output_limits(maxBytes, maxLines)
+    % IMATLAB_OUTPUT_LIMITS Set or get the per-cell output limits of imatlab.
+    %
+    %   IMATLAB_OUTPUT_LIMITS(maxBytes, maxLines)
+    %     sets the maximum number of bytes and of lines of output sent to the
+    %     notebook by each cell (0 or Inf: no limit).  Once a limit is
+    %     reached, the rest of the output is written to a file (in
+    %     IMATLAB_OUTPUT_SPILL_DIR, by default in the temporary folder) and
+    %     only its last lines are shown.  The new limits apply from the next
+    %     cell on.
+    %
+    %   limits = IMATLAB_OUTPUT_LIMITS
+    %     returns the current limits as a struct with fields maxBytes and
+    %     maxLines (NaN if the default is used).
+
+    names = {'IMATLAB_OUTPUT_MAX_BYTES', 'IMATLAB_OUTPUT_MAX_LINES'};
+    if nargin
+        values = {maxBytes, maxLines};
+        for i = 1:2
+            value = values{i};
+            if isinf(value)
+                value = 0;
+            end
+            setenv(names{i}, sprintf('%d', value));
+        end
+    end
+    if nargout || ~nargin
+        limits = struct('maxBytes', str2double(getenv(names{1})), ...
+                        'maxLines', str2double(getenv(names{2})));
+    end
+end
@@ -0,0 +1,21 @@
+function numbers = imatlab_pending_figures()
+    % IMATLAB_PENDING_FIGURES List the figures to be exported after a cell.
+    %
+    %   numbers = IMATLAB_PENDING_FIGURES
+    %     returns the numbers of the figures created during the cell (as
+    %     tracked by imatlab_figure_tracker) to export, in increasing order.
+    %     Empty figures are closed.
+
+    figures = imatlab_figure_tracker('figures');
+    keep = true(numel(figures), 1);
+    for iF = 1:numel(figures)
+        if ~strcmp(figures(iF).HandleVisibility, 'on')
+            keep(iF) = false;
+        elseif isempty(figures(iF).Children)
+            keep(iF) = false;
+            close(figures(iF));
+        end
+    end
+
+    numbers = sort([figures(keep).Number]);
+end
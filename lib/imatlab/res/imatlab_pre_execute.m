@@ -5,25 +5,21 @@ function imatlab_pre_execute()
     setenv('JUPYTER_CURRENTLY_EXECUTING', '1');
 
     exporter = getenv('IMATLAB_FIGURE_EXPORTER');
+
+    % only figures created from now on are exported (figures that already
+    % exist are left alone, except for hidden figures left over from a cell
+    % whose export did not complete)
+    imatlab_figure_tracker('reset', ~strcmp(exporter, ''));
+
     if strcmp(exporter, '')
         % no exporter set, show figures as they are generated
         set(0, 'DefaultFigureVisible', 'on');
     else
-        % exporter set, hide figures for export and mark existing figures to ignore
-        children = get(0, 'children');
-        for iF = 1:numel(children)
-            if strcmp(children(iF).HandleVisibility, 'on')
-                if strcmp(children(iF).Visible, 'on')
-                    children(iF).UserData = struct('imatlab_ignore', true);
-                else
-                    close(children(iF));
-                end
-            end
-        end
+        % exporter set, hide figures for export
         set(0, 'DefaultFigureVisible', 'off');
 
         % ensure that new plot commands go in a new figure
-        figure();
+        set(groot, 'CurrentFigure', []);
     end
 
-end
\ No newline at end of file
+end
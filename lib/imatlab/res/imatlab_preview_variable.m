@@ -0,0 +1,55 @@
+function json = imatlab_preview_variable(name, row, col, page, nRows, nCols)
+    % IMATLAB_PREVIEW_VARIABLE Render a window of a base workspace variable.
+    %
+    %   json = IMATLAB_PREVIEW_VARIABLE(name, row, col, page, nRows, nCols)
+    %     evaluates name (a variable name, or an expression such as s.field)
+    %     in the base workspace and returns, as a JSON object, the elements
+    %     (or, for tables, the cells) in the window of at most nRows x nCols
+    %     (and at most 100 x 100) elements starting at (row, col), rendered
+    %     as text.  For arrays with more than two dimensions, page is the
+    %     linear index of the page over the trailing dimensions.  Only the
+    %     window is copied.
+    %
+    %     The object has the fields class, size, rows and cols (the first
+    %     and last rows and columns of the window), columns (the variable
+    %     names, for tables), and values (an array of rows).
+
+    value = evalin('base', name);
+    cls = class(value);
+    sz = size(value);
+    dims = sz;
+    if ischar(value) && ismatrix(value)
+        % Render each row of char matrices as a whole.
+        value = cellstr(value);
+        dims(2) = 1;
+    elseif isscalar(value) && ~(isnumeric(value) || islogical(value) ...
+                                || istable(value) || istimetable(value))
+        % E.g. function handles and objects, which may not support indexing.
+        value = {value};
+    end
+    rows = row : min(row + min(nRows, 100) - 1, dims(1));
+    cols = col : min(col + min(nCols, 100) - 1, dims(2));
+    columns = {};
+    if istable(value) || istimetable(value)
+        window = value(rows, cols);
+        columns = window.Properties.VariableNames;
+    else
+        window = value(rows, cols, page);
+    end
+    cells = imatlab_format_cells(window);
+    values = cell(1, numel(rows));
+    for i = 1:numel(rows)
+        values{i} = cells(i, :);
+    end
+    json = jsonencode(struct( ...
+        'class', cls, 'size', sz, 'rows', first_last(rows), ...
+        'cols', first_last(cols), 'columns', {columns}, 'values', {values}));
+end
+
+function b = first_last(v)
+    if isempty(v)
+        b = [];
+    else
+        b = [v(1), v(end)];
+    end
+end
@@ -0,0 +1,49 @@
+function imatlab_put_variable(name, in)
+    % IMATLAB_PUT_VARIABLE Assign a transferred array to a base variable.
+    %
+    %   IMATLAB_PUT_VARIABLE(name, in)
+    %     assigns the array described by in (see imatlab_get_variable, whose
+    %     output has the same fields) to the base workspace variable name.
+    %     If in has a file field, the file is read and deleted.  The real and
+    %     imag fields of full arrays may have any shape.
+
+    sz = double(in.size);
+    if in.sparse
+        values = in.real;
+        if in.complex
+            values = complex(values, in.imag);
+        end
+        value = sparse(double(in.rows), double(in.cols), values, sz(1), sz(2));
+        if strcmp(in.class, 'logical')
+            value = logical(value);
+        end
+    elseif isfield(in, 'file')
+        precision = in.class;
+        if strcmp(precision, 'logical')
+            precision = 'uint8';
+        end
+        fid = fopen(in.file, 'r');
+        if fid < 0
+            error('imatlab:transferFailed', 'Cannot open %s.', in.file);
+        end
+        closeFile = onCleanup(@() fclose(fid));
+        n = prod(sz);
+        value = fread(fid, n, [precision, '=>', precision]);
+        if in.complex
+            value = complex(value, fread(fid, n, [precision, '=>', precision]));
+        end
+        clear closeFile
+        delete(in.file);
+        if strcmp(in.class, 'logical')
+            value = logical(value);
+        end
+        value = reshape(value, sz);
+    else
+        value = in.real;
+        if in.complex
+            value = complex(value, in.imag);
+        end
+        value = reshape(value, sz);
+    end
+    assignin('base', name, value);
+end
@@ -0,0 +1,145 @@
+function result = imatlab_run_cell(tryCode, noTryCode, options)
+    % IMATLAB_RUN_CELL Execute a notebook cell and export its figures.
+    %
+    %   result = IMATLAB_RUN_CELL(tryCode, noTryCode, options)
+    %     runs imatlab_pre_execute, evaluates the cell in the base workspace,
+    %     runs imatlab_post_execute, then exports the figures, so that the
+    %     kernel only needs a single engine call per cell.  noTryCode is
+    %     evaluated instead of tryCode (which reports errors itself) if
+    %     "dbstop if error" is set, so that the debugger catches errors.
+    %
+    %   options is a struct with the fields
+    %     export: whether to export figures.
+    %     clearFunctions: cell array of names of functions redefined by the
+    %       cell (or of cell scripts whose files were removed), to be cleared
+    %       from memory before evaluation.
+    %     rehash: whether new function files need a path rehash.
+    %     settings: cell array of names of environment variables whose
+    %       values are reported back after the evaluation.
+    %     liveDir: if not empty, folder to which snapshots of the figures are
+    %       periodically written while the cell runs (see
+    %       imatlab_live_figures).
+    %     liveInterval: minimum interval between snapshots, in seconds.
+    %
+    %   result is a struct with the fields
+    %     exported: cell array containing the export of the first figure
+    %       (see imatlab_export_figure), or empty.
+    %     figures: cell array of the numbers of all the figures to export.
+    %       The caller exports those after the first one at a time with
+    %       imatlab_export_figure, so that each figure can be displayed as
+    %       soon as it is ready.
+    %     exportDir: temporary folder for file-based exporters (to be deleted
+    %       by the caller), or '' if none was needed.
+    %     customExporter: true if imatlab_export_fig has been overridden, in
+    %       which case figures are not exported (the kernel then calls the
+    %       custom exporter itself).
+    %     settings: struct mapping the names in options.settings that are set
+    %       (to a non-empty value) to their values.
+    %     preview: the preview of the value the cell ends with, if the cell
+    %       captured one (see imatlab_display_value), or an empty struct.
+    %     errors: cell array of the messages of errors that occurred after
+    %       the evaluation (in imatlab_post_execute, or while collecting the
+    %       other results or exporting the first figure).  Each part is run
+    %       separately, so that such an error does not lose the other
+    %       results.
+
+    result = struct('exported', {{}}, 'figures', {{}}, ...
+                    'exportDir', '', 'customExporter', false, ...
+                    'settings', struct(), 'preview', struct(), ...
+                    'errors', {{}});
+
+    if ~isempty(options.clearFunctions)
+        clearFunctions(options.clearFunctions);
+    end
+    if options.rehash
+        rehash;
+    end
+
+    imatlab_pre_execute();
+    live = [];
+    if ~isempty(options.liveDir) ...
+            && ~isempty(getenv('IMATLAB_FIGURE_EXPORTER'))
+        live = imatlab_live_figures(options.liveDir, options.liveInterval);
+    end
+    if is_dbstop_if_error()
+        evalin('base', noTryCode);
+    else
+        evalin('base', tryCode);
+    end
+    clear('live');  % Stop the snapshots before the export.
+    try
+        imatlab_post_execute();
+    catch err
+        result.errors{end+1} = sprintf( ...
+            'Error in imatlab_post_execute: %s', err.message);
+    end
+    try
+        result.preview = imatlab_display_value('take');
+    catch err
+        result.errors{end+1} = sprintf( ...
+            'Failed to display the value: %s', err.message);
+    end
+    try
+        for i = 1:numel(options.settings)
+            value = getenv(options.settings{i});
+            if ~isempty(value)
+                result.settings.(options.settings{i}) = value;
+            end
+        end
+    catch err
+        result.errors{end+1} = sprintf( ...
+            'Failed to read the settings: %s', err.message);
+    end
+
+    if ~options.export
+        return
+    end
+    try
+        result = exportFirstFigure(result);
+    catch err
+        result.errors{end+1} = sprintf( ...
+            'Failed to export figures: %s', err.message);
+    end
+end
+
+function result = exportFirstFigure(result)
+    % Export the first figure, and list the others for the caller.
+    if ~imatlab_figure_tracker('any')
+        return
+    end
+    exporter = which('imatlab_export_fig');
+    if isempty(exporter)
+        return
+    end
+    if ~strcmp(fileparts(exporter), fileparts(mfilename('fullpath')))
+        result.customExporter = true;
+        return
+    end
+    exporter = getenv('IMATLAB_FIGURE_EXPORTER');
+    if isempty(exporter)
+        return
+    end
+    numbers = imatlab_pending_figures();
+    if isempty(numbers)
+        return
+    end
+    if startsWith(exporter, 'print-')
+        result.exportDir = tempname();
+        mkdir(result.exportDir);
+    end
+    result.figures = num2cell(numbers);
+    try
+        result.exported = { ...
+            imatlab_export_figure(numbers(1), result.exportDir)};
+    catch err
+        % The caller exports the other figures.
+        result.figures = result.figures(2:end);
+        result.errors{end+1} = sprintf( ...
+            'Failed to export figure %d: %s', numbers(1), err.message);
+    end
+end
+
+function clearFunctions(names)
+    % In a separate function, so that no local variable can be cleared.
+    clear(names{:});
+end
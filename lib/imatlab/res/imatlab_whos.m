@@ -0,0 +1,14 @@
+function json = imatlab_whos()
+    % IMATLAB_WHOS List the variables of the base workspace.
+    %
+    %   json = IMATLAB_WHOS()
+    %     returns, as a JSON array, the name, size, bytes, class, complex,
+    %     sparse and global fields of the output of whos for each variable
+    %     of the base workspace.  The values themselves are not accessed.
+
+    info = evalin('base', 'whos');
+    info = rmfield(info, intersect(fieldnames(info), ...
+                                   {'persistent', 'nesting'}));
+    % jsonencode encodes scalar structs as objects, not arrays.
+    json = jsonencode(num2cell(info(:)'));
+end
@@ -21,8 +21,7 @@ setup(
     ],
     packages=find_packages("lib"),
     package_dir={"": "lib"},
-    package_data={"imatlab": ["res/imatlab_export_fig.m",
-                              "res/is_dbstop_if_error.m",
+    package_data={"imatlab": ["res/*.m",
                               "res/matlab.tpl"]},
     include_package_data=True,
     data_files=DATA_FILES,
@@ -1,7 +1,19 @@
+import importlib.util
+import os
 import re
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+import zlib
 
 import jupyter_kernel_test as jkt
 
+from imatlab import (
+    _engine_pool, _function_store, _images, _redirection, _streams, _syntax)
+
 
 class IMatlabTests(jkt.KernelTests):
 
@@ -37,6 +49,10 @@ class IMatlabTests(jkt.KernelTests):
                  "imatlab_export_fig('print-png'); "
                  "plot([1, 2]);",
          "mime": "image/png"},
+        {"code": "set(0, 'defaultfigurevisible', 'off'); "
+                 "imatlab_export_fig('memory-png'); "
+                 "plot([1, 2]);",
+         "mime": "image/png"},
     ]
     code_inspect_sample = "help"
 
@@ -59,3 +75,549 @@ class IMatlabTests(jkt.KernelTests):
 
     # code_page_something = None
     # code_clear_output = None
+
+    def _stdout(self, code):
+        reply, output_msgs = self.execute_helper(code=code)
+        self.assertEqual(reply["content"]["status"], "ok")
+        return "".join(msg["content"]["text"] for msg in output_msgs
+                       if msg["msg_type"] == "stream"
+                       and msg["content"]["name"] == "stdout")
+
+    def test_cell_functions(self):
+        self.assertIn("3", self._stdout(
+            "disp(test_cell_function([1, 2]))\n"
+            "function y = test_cell_function(x)\n"
+            "  s = 'end'; % end\n"
+            "  y = x(end) + numel(s) - 2;\n"
+            "end"))
+
+    def test_script_execution_mode(self):
+        self._stdout("setenv('IMATLAB_EXECUTION_MODE', 'script');")
+        try:
+            self.assertIn("6", self._stdout(
+                "acc = 0; for i = 1:3, acc = acc + i; end, disp(acc)"))
+        finally:
+            self._stdout("setenv('IMATLAB_EXECUTION_MODE', '');")
+
+    def test_output_limits(self):
+        self._stdout("saved_limits = {getenv('IMATLAB_OUTPUT_MAX_BYTES'), "
+                     "getenv('IMATLAB_OUTPUT_MAX_LINES')}; "
+                     "imatlab_output_limits(1000, 0);")
+        try:
+            reply, output_msgs = self.execute_helper(
+                code="fprintf('%d\\n', 1:10000)")
+            texts = "".join(msg["content"]["text"] for msg in output_msgs
+                            if msg["msg_type"] == "stream")
+            self.assertLess(len(texts), 3000)
+            self.assertIn("10000", texts)
+            self.assertIn("Full output", texts)
+        finally:
+            self._stdout("setenv('IMATLAB_OUTPUT_MAX_BYTES', saved_limits{1}); "
+                         "setenv('IMATLAB_OUTPUT_MAX_LINES', saved_limits{2}); "
+                         "clear saved_limits")
+
+    def test_figures_in_order(self):
+        reply, output_msgs = self.execute_helper(
+            code="set(0, 'defaultfigurevisible', 'off'); "
+                 "imatlab_export_fig('memory-png'); "
+                 "for k = 1:5, figure(); plot(1:k); end")
+        self.assertEqual(reply["content"]["status"], "ok")
+        figures = [msg for msg in output_msgs
+                   if msg["msg_type"] == "display_data"]
+        self.assertEqual(len(figures), 5)
+        self.assertTrue(all("image/png" in msg["content"]["data"]
+                            for msg in figures))
+
+    def test_existing_figures_not_exported(self):
+        self._stdout("imatlab_export_fig(''); test_fig = figure(); plot(1:2);")
+        try:
+            reply, output_msgs = self.execute_helper(
+                code="imatlab_export_fig('memory-png'); plot(1:3);")
+            self.assertEqual(
+                len([msg for msg in output_msgs
+                     if msg["msg_type"] == "display_data"]), 1)
+        finally:
+            self._stdout("close(test_fig); imatlab_export_fig('');")
+
+    @unittest.skipUnless(importlib.util.find_spec("PIL"), "Requires Pillow")
+    def test_figure_gallery(self):
+        self._stdout("setenv('IMATLAB_FIGURE_GALLERY', '2');")
+        try:
+            reply, output_msgs = self.execute_helper(
+                code="set(0, 'defaultfigurevisible', 'off'); "
+                     "imatlab_export_fig('memory-png'); "
+                     "for k = 1:3, figure(); plot(1:k); end")
+            displays = [msg for msg in output_msgs
+                        if msg["msg_type"] == "display_data"]
+            self.assertEqual(len(displays), 1)
+            self.assertEqual(
+                displays[0]["content"]["data"]["text/html"].count("<img"), 3)
+        finally:
+            self._stdout("setenv('IMATLAB_FIGURE_GALLERY', '');")
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "Requires NumPy")
+    def test_transfer_variables(self):
+        import numpy as np
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "x.npy")
+            self._stdout("x = reshape(1:6, 2, 3) + 1i;\n%get x " + path)
+            np.testing.assert_array_equal(
+                np.load(path), np.arange(1, 7).reshape(2, 3, order="F") + 1j)
+            np.save(path, np.eye(3, dtype=bool))
+            self.assertIn("1", self._stdout(
+                "%put y " + path + "\ndisp(isequal(y, logical(eye(3))))"))
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"),
+                         "Requires pyarrow")
+    def test_export_table(self):
+        import pyarrow.parquet as pq
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "t.parquet")
+            self._stdout("t = table((1:5)', string(1:5)', "
+                         "'VariableNames', {'x', 'y'});\n%get t " + path)
+            table = pq.read_table(path)
+            self.assertEqual(table.column_names, ["x", "y"])
+            self.assertEqual(table.column("x").to_pylist(), [1, 2, 3, 4, 5])
+
+    def _comm_request(self, target, data):
+        comm_id = uuid.uuid4().hex
+        for msg_type, content in [
+                ("comm_open", {"comm_id": comm_id, "target_name": target,
+                               "data": {}}),
+                ("comm_msg", {"comm_id": comm_id, "data": data})]:
+            self.kc.shell_channel.send(
+                self.kc.session.msg(msg_type, content))
+        while True:
+            msg = self.kc.get_iopub_msg(timeout=60)
+            if (msg["msg_type"] == "comm_msg"
+                    and msg["content"]["comm_id"] == comm_id):
+                return msg["content"]["data"]
+
+    def test_variable_inspector(self):
+        self._stdout("inspected = reshape(1:300 * 300, 300, 300);")
+        variables = self._comm_request(
+            "imatlab.inspector", {"request": "list", "id": 1})["variables"]
+        self.assertIn({"name": "inspected", "size": [300, 300],
+                       "bytes": 720000, "class": "double", "complex": False,
+                       "sparse": False, "global": False},
+                      variables)
+        preview = self._comm_request(
+            "imatlab.inspector",
+            {"request": "preview", "name": "inspected", "id": 2,
+             "row": 251, "col": 2, "rows": 1000, "cols": 1000})
+        self.assertEqual(preview["id"], 2)
+        self.assertEqual(preview["rows"], [251, 300])
+        self.assertEqual(preview["cols"], [2, 101])
+        self.assertEqual(preview["values"][0][0], "551")
+
+    def test_display_value_preview(self):
+        reply, output_msgs = self.execute_helper(
+            code="displayed = reshape(1:1000, 100, 10);\ndisplayed")
+        self.assertEqual(reply["content"]["status"], "ok")
+        displays = [msg for msg in output_msgs
+                    if msg["msg_type"] == "display_data"]
+        self.assertEqual(len(displays), 1)
+        data = displays[0]["content"]["data"]
+        self.assertIn("displayed: 100\N{MULTIPLICATION SIGN}10 double",
+                      data["text/plain"])
+        self.assertIn("\N{VERTICAL ELLIPSIS}", data["text/html"])
+        # Header, 20 rows, and the gap between the first and last ten.
+        self.assertEqual(data["text/html"].count("<tr>"), 22)
+        # Scalars are displayed as usual.
+        self.assertIn("101", self._stdout("displayed(1, 2)"))
+
+
+class StreamBatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.batcher = _streams.StreamBatcher(
+            lambda name, text: self.sent.append((name, text)), interval=10)
+        self.addCleanup(self.batcher.close)
+
+    def test_split_multibyte_characters(self):
+        text = "h\N{LATIN SMALL LETTER E WITH ACUTE}\N{EURO SIGN}"
+        data = text.encode("utf-8")
+        for k in range(len(data)):
+            self.batcher.write("stdout", data[k:k + 1])
+        self.assertTrue(self.batcher.flush(timeout=5))
+        self.assertEqual(self.sent, [("stdout", text)])
+
+    def test_coalesced_in_order(self):
+        for name, text in [("stdout", "a"), ("stdout", "b"), ("stderr", "c"),
+                           ("stdout", "d")]:
+            self.batcher.write_text(name, text)
+        self.assertTrue(self.batcher.flush(timeout=5))
+        self.assertEqual(
+            self.sent, [("stdout", "ab"), ("stderr", "c"), ("stdout", "d")])
+
+
+@unittest.skipUnless(os.name == "posix", "The kernel only redirects on POSIX")
+class RedirectorTests(unittest.TestCase):
+
+    def test_drain(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        received = []
+        redirector = _redirection.Redirector(
+            {write_fd: lambda data: received.append(bytes(data))},
+            min_read=16, max_read=64)
+        try:
+            for k in range(100):
+                os.write(write_fd, "line {}\n".format(k).encode("ascii"))
+            self.assertTrue(redirector.drain(timeout=5))
+            self.assertEqual(
+                b"".join(received).decode("ascii"),
+                "".join("line {}\n".format(k) for k in range(100)))
+        finally:
+            redirector.close()
+        # The fd is restored.
+        os.write(write_fd, b"direct")
+        self.assertEqual(os.read(read_fd, 6), b"direct")
+
+
+class EncodePngTests(unittest.TestCase):
+
+    def test_encode_png(self):
+        width, height = 3, 2
+        pixels = bytes(range(3 * width * height))
+        png = _images.encode_png(memoryview(pixels), width, height)
+        self.assertEqual(png[:8], b"\x89PNG\r\n\x1a\n")
+        chunks = {}
+        pos = 8
+        while pos < len(png):
+            length, = struct.unpack(">I", png[pos:pos + 4])
+            kind, data = png[pos + 4:pos + 8], png[pos + 8:pos + 8 + length]
+            crc, = struct.unpack(
+                ">I", png[pos + 8 + length:pos + 12 + length])
+            self.assertEqual(crc, zlib.crc32(kind + data))
+            chunks[kind] = data
+            pos += 12 + length
+        self.assertEqual(list(chunks), [b"IHDR", b"IDAT", b"IEND"])
+        self.assertEqual(struct.unpack(">IIBBBBB", chunks[b"IHDR"]),
+                         (width, height, 8, 2, 0, 0, 0))
+        stride = 3 * width
+        self.assertEqual(
+            zlib.decompress(chunks[b"IDAT"]),
+            b"".join(b"\0" + pixels[y * stride:(y + 1) * stride]
+                     for y in range(height)))
+
+    def test_wrong_size(self):
+        with self.assertRaises(ValueError):
+            _images.encode_png(bytes(10), 2, 2)
+
+
+class FunctionStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+        self.store = _function_store.FunctionStore(
+            self.directory, max_scripts=2)
+
+    def test_update(self):
+        self.assertEqual(self.store.update([("f", "function f\nend")]),
+                         ([], ["f"]))
+        self.assertEqual(self.store.update([("f", "function f\nend")]),
+                         ([], []))
+        self.assertEqual(self.store.update([("f", "function f()\nend")]),
+                         (["f"], []))
+        with open(os.path.join(self.directory, "f.m")) as file:
+            self.assertEqual(file.read(), "function f()\nend")
+
+    def test_scripts_evicted(self):
+        a, added, removed = self.store.add_script("a = 1")
+        self.assertTrue(added)
+        self.assertEqual(removed, [])
+        b, _, _ = self.store.add_script("b = 1")
+        self.assertEqual(self.store.add_script("a = 1"), (a, False, []))
+        c, added, removed = self.store.add_script("c = 1")
+        self.assertTrue(added)
+        self.assertEqual(removed, [b])  # The least recently run.
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted([a + ".m", c + ".m"]))
+
+
+class EnginePoolTests(unittest.TestCase):
+
+    class Engine:
+        def __init__(self, number):
+            self.number = number
+            self.exited = False
+
+        def exit(self):
+            self.exited = True
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = self.max_running = 0
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def start(self):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        self.gate.wait(5)
+        with self.lock:
+            self.running -= 1
+            engine = self.Engine(len(self.started))
+            self.started.append(engine)
+        return engine
+
+    def make_pool(self, size, idle_timeout=None):
+        pool = _engine_pool.EnginePool(self.start, size, idle_timeout)
+        self.addCleanup(pool.close)
+        return pool
+
+    def wait_until(self, predicate):
+        deadline = time.monotonic() + 5
+        while not predicate():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_hands_over_spares(self):
+        pool = self.make_pool(1)
+        self.wait_until(lambda: len(self.started) == 1)
+        self.assertIs(pool.acquire(), self.started[0])
+        self.wait_until(lambda: len(self.started) == 2)  # Refilled.
+        pool.close()
+        self.assertTrue(self.started[1].exited)
+
+    def test_acquire_waits_for_start_in_progress(self):
+        self.gate.clear()
+        pool = self.make_pool(1)
+        self.wait_until(lambda: self.running == 1)
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(pool.acquire()))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(acquired, [])
+        self.gate.set()
+        thread.join(5)
+        self.assertEqual(acquired, [self.started[0]])
+        self.assertEqual(self.max_running, 1)
+
+    def test_idle_spares_shut_down(self):
+        pool = self.make_pool(1, idle_timeout=0.05)
+        self.wait_until(lambda: self.started and self.started[0].exited)
+        time.sleep(0.1)
+        self.assertEqual(len(self.started), 1)  # Not refilled until needed.
+        self.assertIs(pool.acquire(), self.started[1])
+
+
+class OutputGuardTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.guard = _streams.OutputGuard(
+            lambda name, text: self.sent.append((name, text)), tail_lines=2)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.spill_dir = tmpdir.name
+
+    def test_under_limits(self):
+        self.guard.start(100, 10, self.spill_dir, "cell")
+        self.guard.send("stdout", "a\n")
+        self.guard.send("stderr", "b\n")
+        self.guard.finish()
+        self.assertEqual(self.sent, [("stdout", "a\n"), ("stderr", "b\n")])
+        self.assertEqual(os.listdir(self.spill_dir), [])
+
+    def test_spill_and_tail(self):
+        self.guard.start(0, 3, self.spill_dir, "cell")
+        for k in range(10):
+            self.guard.send("stdout", "{}\n".format(k))
+        self.guard.send("stderr", "error\n")
+        self.guard.finish()
+        streams = [(name, text) for name, text in self.sent
+                   if not text.lstrip().startswith("[")]
+        self.assertEqual(
+            streams,
+            [("stdout", "0\n"), ("stdout", "1\n"), ("stdout", "2\n"),
+             # The last two lines, each on its own stream.
+             ("stdout", "9\n"), ("stderr", "error\n")])
+        spill, = os.listdir(self.spill_dir)
+        with open(os.path.join(self.spill_dir, spill)) as file:
+            self.assertEqual(
+                file.read(),
+                "".join("{}\n".format(k) for k in range(10)) + "error\n")
+        self.assertIn(spill, self.sent[-1][1])
+
+    def test_no_spill_file(self):
+        path = os.path.join(self.spill_dir, "file")
+        open(path, "w").close()
+        self.guard.start(0, 1, path, "cell")  # Not a folder.
+        self.guard.send("stdout", "a\nb\n")
+        self.guard.finish()
+        self.assertIn("discarded", self.sent[-1][1])
+
+
+class ProgressCompactorTests(unittest.TestCase):
+
+    class Timer:
+        def __init__(self, interval, function):
+            self.interval = interval
+            self.function = function
+            self.cancelled = False
+
+        def start(self):
+            pass
+
+        def cancel(self):
+            self.cancelled = True
+
+    def setUp(self):
+        self.now = 0
+        self.timers = []
+        self.shown = []
+
+        def make_timer(interval, function):
+            self.timers.append(self.Timer(interval, function))
+            return self.timers[-1]
+
+        self.compactor = _streams.ProgressCompactor(
+            lambda name, text: self.shown.append(text),
+            lambda text, display_id, update: self.shown.append(text), 0.2,
+            clock=lambda: self.now, timer=make_timer)
+
+    def test_throttled_update_sent_after_interval(self):
+        self.compactor.send("stdout", "\r10%")
+        self.now = 0.05
+        self.compactor.send("stdout", "\r11%")
+        self.now = 0.1
+        self.compactor.send("stdout", "\r12%")
+        self.assertEqual(self.shown, ["10%"])
+        # A single timer, for the end of the interval.
+        timer, = self.timers
+        self.assertAlmostEqual(timer.interval, 0.15)
+        self.now = 0.2  # No further output.
+        timer.function()
+        self.assertEqual(self.shown, ["10%", "12%"])
+        self.compactor.finish()
+        self.assertEqual(self.shown, ["10%", "12%"])
+
+    def test_finish_cancels_timer(self):
+        self.compactor.send("stdout", "\r10%")
+        self.compactor.send("stdout", "\r11%")
+        self.compactor.send("stdout", "\n")
+        self.compactor.finish()
+        self.assertEqual(self.shown, ["10%", "11%"])
+        timer, = self.timers
+        self.assertTrue(timer.cancelled)
+        timer.function()  # Fired anyway.
+        self.assertEqual(self.shown, ["10%", "11%"])
+
+class SyntaxTests(unittest.TestCase):
+
+    def test_tokenize(self):
+        for code, expected in [
+                # Transposes vs. strings.
+                ("a' + 'b'",
+                 [("name", "a"), ("op", "'"), ("op", "+"),
+                  ("string", "'b'")]),
+                ("[c 'd'] + x.'",
+                 [("op", "["), ("name", "c"), ("string", "'d'"),
+                  ("op", "]"), ("op", "+"), ("name", "x"), ("op", ".'")]),
+                ("(a)' \"e'\"",
+                 [("op", "("), ("name", "a"), ("op", ")"), ("op", "'"),
+                  ("string", "\"e'\"")]),
+                # Command syntax, comments and continuations.
+                ("hold on % c\nx = 1;",
+                 [("name", "hold"), ("command", "on"), ("eos", "\n"),
+                  ("name", "x"), ("op", "="), ("number", "1"),
+                  ("eos", ";")]),
+                ("x = [1, ...\n2];",
+                 [("name", "x"), ("op", "="), ("op", "["), ("number", "1"),
+                  ("op", ","), ("number", "2"), ("op", "]"), ("eos", ";")]),
+                ("%{\nx\n%}\ny",
+                 [("eos", "\n"), ("name", "y")]),
+        ]:
+            with self.subTest(code=code):
+                self.assertEqual(
+                    [(token.kind, token.text)
+                     for token in _syntax.tokenize(code)],
+                    expected)
+
+    def test_extract_functions(self):
+        for code, expected in [
+                ("disp(1)", ("disp(1)", [])),
+                ("% function foo\ndisp(1)", ("% function foo\ndisp(1)", [])),
+                ("functions = 1; disp(functions)",
+                 ("functions = 1; disp(functions)", [])),
+                ("disp(f(1))\nfunction y = f(x)\n  y = x(end) + 1;\nend\n",
+                 ("disp(f(1))\n",
+                  [("f", "function y = f(x)\n  y = x(end) + 1;\nend")])),
+                ("a=1;\nfunction f(x)\n  if x, y = 1; end\n"
+                 "  for i=1:3\n  end\nend\nb=2",
+                 ("a=1;\nb=2",
+                  [("f", "function f(x)\n  if x, y = 1; end\n"
+                         "  for i=1:3\n  end\nend")])),
+                ("function a()\nend\nfunction b()\nend\ndisp(1)",
+                 ("disp(1)",
+                  [("a", "function a()\nend"), ("b", "function b()\nend")])),
+                ("function f(), disp(1), end",
+                 ("", [("f", "function f(), disp(1), end")])),
+        ] + [
+                # `end` that does not close a block.
+                ("function f()\n{}\nend".format(body),
+                 ("", [("f", "function f()\n{}\nend".format(body))]))
+                for body in [
+                    "  s = 'end';\n  t = \"end\";",
+                    "  s = \"a\"\"end\";",
+                    "  x = a';\n  y = [a' b'];\n  z = (a)';\n  w = x.';",
+                    "%{\nend\n%}",
+                    "  x = [1, ...\n  2]; % end",
+                    "  x = [1\n  2];\n  y = {1\n  2};",
+                    "  x = g(1, ...\n  2);",
+                    "  x = a(end-1:end);",
+                    "  s.end = 1; x = s.if;",
+                    "  disp 'end'",
+                    "  while true, break, end",
+                    "  arguments\n    x double\n  end",
+                ]
+        ]:
+            with self.subTest(code=code):
+                self.assertEqual(_syntax.extract_functions(code), expected)
+
+    def test_extract_functions_unsure(self):
+        # These are left to `mtree`.
+        for code in [
+                "x=1;\nfunction f()\n  x=1;\n",  # No `end`.
+                "x=1; function f()\nend",
+                "function f\nend x = 1;",
+                "end\nfunction f\nend",
+                "classdef A\nend\nfunction f\nend",
+                "function get.x(o)\nend",
+                "function f\n x = 'abc;\nend",
+                "function f\n x = [1;\nend",
+                "function f\n x = g(1,\n 2);\nend",
+                "!ls\nfunction f\nend",
+        ]:
+            with self.subTest(code=code):
+                self.assertIsNone(_syntax.extract_functions(code))
+
+    def test_trailing_expression(self):
+        for code, expected in [
+                ("x", ("", "x", "x")),
+                ("x % note;", ("", "x", "x")),
+                ("x ...\n", ("", "x", "x")),
+                ("x = 1\nx", ("x = 1\n", "x", "x")),
+                ("x, y", ("x, ", "y", "y")),
+                ("s.a{2}(1:3, :)  % c\n", ("", "s", "s.a{2}(1:3, :)")),
+                ("x(end)", ("", "x", "x(end)")),
+                # Whether these are variables is left to MATLAB.
+                ("figure", ("", "figure", "figure")),
+                ("plot(x)", ("", "plot", "plot(x)")),
+        ]:
+            with self.subTest(code=code):
+                self.assertEqual(_syntax.trailing_expression(code), expected)
+        for code in ["x;", "x; % c", "x = 3; x, y = 2;", "a = 1", "x'",
+                     "x(1)'", "hold on", "disp hello", "if x, y, end",
+                     "for i=1:3\n i\nend", "x(1,\n2)"]:
+            with self.subTest(code=code):
+                self.assertIsNone(_syntax.trailing_expression(code))